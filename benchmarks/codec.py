@@ -0,0 +1,63 @@
+# Micro-benchmark of the code conversions, run with:
+#   python benchmarks/codec.py [--number N]
+import argparse
+import random
+import timeit
+from broadlink_bridge import codec
+from broadlink_bridge.util import DECODE_CACHE, ir_decode, ir_decode_pronto, ir_decode_uncached
+
+def pronto(pairs, frequency=0x006D):
+    words = [0x0000, frequency, len(pairs), 0x0000]
+    for pair in pairs:
+        words.extend(pair)
+    return ''.join('%04X' % word for word in words)
+
+def samples():
+    random.seed(0)
+    # NEC-like: header, 32 bits, trailer
+    nec = [(0x0156, 0x00AB)] + [(0x0015, random.choice((0x0015, 0x0040))) for _ in range(32)] + [(0x0015, 0x05ED)]
+    # AC state: 3 frames of 112 bits
+    ac = []
+    for _ in range(3):
+        ac += [(0x0080, 0x0040)] + [(0x0010, random.choice((0x0010, 0x0030))) for _ in range(112)] + [(0x0010, 0x0ACD)]
+    # RF-like: long pulses that need the 3-byte escape
+    rf = [(random.choice((0x0200, 0x0600)), random.choice((0x0200, 0x0600))) for _ in range(600)] + [(0x0200, 0x3000)]
+    return [
+        ('short IR', pronto(nec)),
+        ('long AC state', pronto(ac)),
+        ('RF', pronto(rf)),
+    ]
+
+def bench(label, func, number):
+    seconds = timeit.timeit(func, number=number)
+    print('  %-34s %8.1f µs/code' % (label, seconds / number * 1e6))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the code conversions')
+    parser.add_argument('--number', type=int, default=2000, help='iterations per measurement')
+    args = parser.parse_args()
+
+    numpy = codec.numpy
+    for (name, code) in samples():
+        packet = codec.pronto_to_broadlink(code)
+        print('%s: %d pulses, %d bytes' % (name, len(codec.broadlink_to_units(packet)), len(packet)))
+        variants = [('pure Python', None)]
+        if numpy is not None:
+            variants.append(('NumPy', numpy))
+        for (variant, module) in variants:
+            codec.numpy = module
+            bench('pronto -> broadlink (%s)' % variant, lambda: codec.pronto_to_broadlink(code), args.number)
+        codec.numpy = numpy
+        bench('ir_decode_pronto', lambda: ir_decode_pronto(code), args.number)
+        bench('ir_decode (uncached)', lambda: ir_decode_uncached(code), args.number)
+        DECODE_CACHE.clear()
+        bench('ir_decode (cached)', lambda: ir_decode(code), args.number)
+        bench('broadlink -> units', lambda: codec.broadlink_to_units(packet), args.number)
+        bench('broadlink -> pronto', lambda: codec.broadlink_to_pronto(packet), args.number)
+        normalized = codec.normalize(packet)
+        print('  normalized: %d bytes (equivalent: %s)' % (len(normalized), codec.equivalent(packet, normalized)))
+        bench('normalize', lambda: codec.normalize(packet), args.number)
+        bench('equivalent', lambda: codec.equivalent(packet, normalized), args.number)
+
+if __name__ == '__main__':
+    main()
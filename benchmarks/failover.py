@@ -0,0 +1,136 @@
+# Cluster mode check: starts bridge instances (as separate processes) sharing
+# simulated devices through a local broker stand-in, verifies that each code
+# is sent exactly once, then kills an instance and measures how long it takes
+# for its devices to move. The simulated devices listen on port 80 of
+# 127.0.0.2 and up (so that the bridge can reach them like real devices),
+# which needs the privilege to bind there. Run with:
+#   python benchmarks/failover.py [--nodes N] [--devices M] [--keepalive S]
+import argparse
+import http.client
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import warnings
+import paho.mqtt.client as mqtt_client
+from fakebroker import Broker
+from fakedevice import FakeDevice
+from load import CODE, free_port
+
+CONFIG = '''[state]
+file = {state}
+[discovery]
+interval = 0
+timeout = 1
+[http]
+port = {port}
+[lirc]
+port = 0
+[mqtt]
+broker_url = {broker}
+keepalive = {keepalive}
+[cluster]
+enabled = yes
+node_id = {node}
+http_url = http://127.0.0.1:{port}
+[devices]
+{devices}
+'''
+
+def request(port, method, path, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        conn.request(method, path, body=body)
+        response = conn.getresponse()
+        return (response.status, response.read())
+    finally:
+        conn.close()
+
+def owners(port, devices):
+    return [json.loads(request(port, 'GET', '/device/dev%d' % i)[1]).get('owner') for i in range(len(devices))]
+
+def cluster_size(port):
+    try:
+        metrics = request(port, 'GET', '/metrics')[1].decode('UTF-8')
+    except OSError:
+        return 0
+    for line in metrics.splitlines():
+        if line.startswith('broadlink_bridge_cluster_nodes '):
+            return int(line.split()[1])
+    return 0
+
+def wait_for(condition, timeout):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if condition():
+            return time.monotonic() - start
+        time.sleep(0.1)
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Cluster mode failover check')
+    parser.add_argument('--nodes', type=int, default=3, help='bridge instances')
+    parser.add_argument('--devices', type=int, default=6, help='simulated devices')
+    parser.add_argument('--keepalive', type=int, default=5, help='MQTT keepalive in seconds')
+    args = parser.parse_args()
+    # paho-mqtt 2.x warns about the callback API version
+    warnings.simplefilter('ignore', DeprecationWarning)
+
+    devices = [FakeDevice(host='127.0.0.%d' % (i + 2), port=80).start() for i in range(args.devices)]
+    broker = Broker().start()
+    directory = tempfile.mkdtemp()
+    nodes = {}
+    for n in range(args.nodes):
+        node = 'node%d' % n
+        state = os.path.join(directory, node + '.json')
+        with open(state, 'w') as f:
+            json.dump({'devices': [dict(device.state, alias='dev%d' % i) for (i, device) in enumerate(devices)]}, f)
+        port = free_port()
+        path = os.path.join(directory, node + '.ini')
+        with open(path, 'w') as f:
+            f.write(CONFIG.format(state=state, port=port, broker=broker.url, keepalive=args.keepalive, node=node,
+                                  devices='\n'.join('dev%d = %s' % (i, device.address[0]) for (i, device) in enumerate(devices))))
+        log = open(os.path.join(directory, node + '.log'), 'w')
+        nodes[node] = (port, subprocess.Popen(['broadlink-bridge', path], stdout=log, stderr=subprocess.STDOUT))
+    try:
+        ports = [port for (port, process) in nodes.values()]
+        if wait_for(lambda: all(cluster_size(port) == args.nodes for port in ports), 15) is None:
+            print('instances did not all see each other')
+        view = owners(ports[0], devices)
+        print('owners: %s (same on every instance: %s)' % (view, all(owners(port, devices) == view for port in ports)))
+
+        publisher = mqtt_client.Client()
+        publisher.connect(*broker.server_address)
+        publisher.loop_start()
+        sent = sum(device.codes for device in devices)
+        for i in range(len(devices)):
+            publisher.publish('broadlink/device/dev%d/transmit' % i, CODE)
+        time.sleep(1)
+        print('mqtt: %d codes published, %d sent' % (len(devices), sum(device.codes for device in devices) - sent))
+        sent = sum(device.codes for device in devices)
+        statuses = [request(ports[0], 'POST', '/device/dev%d' % i, CODE)[0] for i in range(len(devices))]
+        print('http via %s: statuses %s, %d sent' % (list(nodes)[0], statuses,
+                                                    sum(device.codes for device in devices) - sent))
+
+        victim = view[0]
+        survivor = next(port for (node, (port, process)) in nodes.items() if node != victim)
+        nodes[victim][1].kill()
+        moved = wait_for(lambda: victim not in owners(survivor, devices), args.keepalive * 3)
+        print('killed %s: devices moved after %s seconds' % (victim, '%.1f' % moved if moved is not None else 'more than %d' % (args.keepalive * 3)))
+        print('owners: %s' % owners(survivor, devices))
+        sent = sum(device.codes for device in devices)
+        for i in range(len(devices)):
+            publisher.publish('broadlink/device/dev%d/transmit' % i, CODE)
+        time.sleep(1)
+        print('mqtt: %d codes published, %d sent' % (len(devices), sum(device.codes for device in devices) - sent))
+        publisher.loop_stop()
+    finally:
+        for (port, process) in nodes.values():
+            process.terminate()
+            process.wait()
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
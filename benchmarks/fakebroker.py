@@ -0,0 +1,247 @@
+# Minimal in-process MQTT 3.1.1 broker stand-in for benchmarks: connect,
+# subscribe/unsubscribe with wildcards, publish (QoS 0-2 accepted, always
+# delivered with QoS 0), retained messages, last will and keepalive pings.
+# Run standalone with:
+#   python benchmarks/fakebroker.py [--port 1883]
+import argparse
+import socketserver
+import threading
+import time
+
+CONNECT     = 1
+CONNACK     = 2
+PUBLISH     = 3
+PUBACK      = 4
+PUBREC      = 5
+PUBREL      = 6
+PUBCOMP     = 7
+SUBSCRIBE   = 8
+SUBACK      = 9
+UNSUBSCRIBE = 10
+UNSUBACK    = 11
+PINGREQ     = 12
+PINGRESP    = 13
+DISCONNECT  = 14
+
+def topic_matches(pattern, topic):
+    pattern = pattern.split('/')
+    topic = topic.split('/')
+    for (i, part) in enumerate(pattern):
+        if part == '#':
+            return True
+        if i >= len(topic) or (part != '+' and part != topic[i]):
+            return False
+    return len(pattern) == len(topic)
+
+def encode_length(length):
+    out = bytearray()
+    while True:
+        (length, byte) = divmod(length, 128)
+        out.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(out)
+
+def encode_string(data):
+    if isinstance(data, str):
+        data = data.encode('UTF-8')
+    return len(data).to_bytes(2, 'big') + data
+
+def packet(type, flags, body):
+    return bytes([type << 4 | flags]) + encode_length(len(body)) + body
+
+class Session:
+    def __init__(self, handler):
+        self.handler = handler
+        self.client_id = None
+        self.subscriptions = {}
+        self.will = None
+        self._lock = threading.Lock()
+
+    def send(self, data):
+        with self._lock:
+            try:
+                self.handler.request.sendall(data)
+            except OSError:
+                pass
+
+class Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        broker = self.server
+        session = Session(self)
+        self.buffer = b''
+        clean = False
+        try:
+            while True:
+                read = self.read_packet()
+                if read is None:
+                    break
+                (type, flags, body) = read
+                if type == CONNECT:
+                    self.connect(session, body)
+                elif type == PUBLISH:
+                    self.publish(session, flags, body)
+                elif type == PUBREL:
+                    session.send(packet(PUBCOMP, 0, body[:2]))
+                elif type == SUBSCRIBE:
+                    self.subscribe(session, body)
+                elif type == UNSUBSCRIBE:
+                    self.unsubscribe(session, body)
+                elif type == PINGREQ:
+                    session.send(packet(PINGRESP, 0, b''))
+                elif type == DISCONNECT:
+                    clean = True
+                    break
+        except (OSError, ValueError):
+            pass
+        finally:
+            broker.remove(session)
+            if session.will and not clean:
+                broker.publish(*session.will)
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            data = self.request.recv(65536)
+            if not data:
+                return None
+            self.buffer += data
+        (data, self.buffer) = (self.buffer[:size], self.buffer[size:])
+        return data
+
+    def read_packet(self):
+        header = self.read(1)
+        if header is None:
+            return None
+        length = 0
+        shift = 0
+        while True:
+            byte = self.read(1)
+            if byte is None:
+                return None
+            length |= (byte[0] & 0x7f) << shift
+            shift += 7
+            if not byte[0] & 0x80:
+                break
+        body = self.read(length) if length else b''
+        if body is None:
+            return None
+        return (header[0] >> 4, header[0] & 0x0f, body)
+
+    def connect(self, session, body):
+        i = 2 + int.from_bytes(body[0:2], 'big')
+        flags = body[i + 1]
+        i += 4
+        (session.client_id, i) = self.string(body, i)
+        if flags & 0x04:
+            (topic, i) = self.string(body, i)
+            length = int.from_bytes(body[i:i + 2], 'big')
+            message = body[i + 2:i + 2 + length]
+            i += 2 + length
+            session.will = (topic, message, bool(flags & 0x20))
+        self.server.add(session)
+        session.send(packet(CONNACK, 0, b'\x00\x00'))
+
+    def publish(self, session, flags, body):
+        (topic, i) = self.string(body, 0)
+        qos = (flags >> 1) & 0x03
+        if qos:
+            packet_id = body[i:i + 2]
+            i += 2
+            session.send(packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+        self.server.publish(topic, body[i:], bool(flags & 0x01))
+
+    def subscribe(self, session, body):
+        i = 2
+        granted = bytearray()
+        patterns = []
+        while i < len(body):
+            (pattern, i) = self.string(body, i)
+            i += 1
+            session.subscriptions[pattern] = True
+            patterns.append(pattern)
+            granted.append(0)
+        session.send(packet(SUBACK, 0, body[:2] + bytes(granted)))
+        for pattern in patterns:
+            for (topic, message) in self.server.retained_for(pattern):
+                session.send(packet(PUBLISH, 0x01, encode_string(topic) + message))
+
+    def unsubscribe(self, session, body):
+        i = 2
+        while i < len(body):
+            (pattern, i) = self.string(body, i)
+            session.subscriptions.pop(pattern, None)
+        session.send(packet(UNSUBACK, 0, body[:2]))
+
+    def string(self, body, i):
+        length = int.from_bytes(body[i:i + 2], 'big')
+        return (body[i + 2:i + 2 + length].decode('UTF-8'), i + 2 + length)
+
+class Broker(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), Handler)
+        self.sessions = []
+        self.retained = {}
+        self.published = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'mqtt://%s:%s' % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='fake-broker')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def add(self, session):
+        with self._lock:
+            self.sessions.append(session)
+
+    def remove(self, session):
+        with self._lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    def retained_for(self, pattern):
+        with self._lock:
+            return [(topic, message) for (topic, message) in self.retained.items()
+                    if topic_matches(pattern, topic)]
+
+    def publish(self, topic, message, retain=False):
+        with self._lock:
+            self.published += 1
+            if retain:
+                if message:
+                    self.retained[topic] = message
+                else:
+                    self.retained.pop(topic, None)
+            sessions = [session for session in self.sessions
+                        if any(topic_matches(pattern, topic) for pattern in list(session.subscriptions))]
+        data = packet(PUBLISH, 0, encode_string(topic) + message)
+        for session in sessions:
+            session.send(data)
+
+def main():
+    parser = argparse.ArgumentParser(description='Minimal MQTT broker stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    args = parser.parse_args()
+
+    broker = Broker(args.host, args.port).start()
+    print('Broker listening on %s' % broker.url)
+    try:
+        while True:
+            time.sleep(10)
+            print('clients: %s, published: %s' % (len(broker.sessions), broker.published))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
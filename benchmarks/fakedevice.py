@@ -0,0 +1,191 @@
+# Simulated Broadlink RM device: a local UDP responder that speaks enough of
+# the protocol (hello, auth, send_data, learning and other 0x6a commands) for
+# the bridge and python-broadlink to talk to it. Run standalone with:
+#   python benchmarks/fakedevice.py [--port 8080] [--latency MS] ...
+import argparse
+import os
+import random
+import socket
+import threading
+import time
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+INIT_KEY  = bytes.fromhex('097628343fe99e23765c1513accf8b02')
+INIT_VECT = bytes.fromhex('562e17996d093d28ddb3ba695a2e6f58')
+HEADER    = bytes.fromhex('5aa5aa555aa5aa55')
+RM_MINI_3 = 0x27c2
+RM_PRO    = 0x272a
+READ_ERROR = -10
+
+def checksum(data):
+    return sum(data, 0xbeaf) & 0xffff
+
+class FakeDevice:
+    def __init__(self, host='127.0.0.1', port=0, mac=None, devtype=RM_MINI_3, name='Fake RM',
+                 latency=0, jitter=0, loss=0, offline=False):
+        self.mac = mac or bytes([0x02]) + os.urandom(5)
+        self.devtype = devtype
+        self.name = name
+        # seconds, the actual delay is latency +/- jitter
+        self.latency = latency
+        self.jitter = jitter
+        # probability of not answering a packet
+        self.loss = loss
+        # when set, nothing is answered at all
+        self.offline = offline
+        # code handed out by check_data once learning, as if a button had
+        # been pressed (and a frequency found, for RF)
+        self.learned = None
+        self.learning = False
+        self.id = random.randint(1, 0xffffffff)
+        self.key = os.urandom(16)
+        self.received = 0
+        self.answered = 0
+        self.dropped = 0
+        self.codes = 0
+        self._random = random.Random()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._sock.getsockname()
+
+    @property
+    def state(self):
+        # entry in the format of the bridge state file, so that the device
+        # can be used without a hello/auth round trip
+        return {
+            'host': self.address[0],
+            'address': self.address[0],
+            'port': self.address[1],
+            'mac': self.mac.hex(),
+            'devtype': self.devtype,
+            'name': self.name,
+            'id': self.id,
+            'key': self.key.hex(),
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, name='fake-%s' % self.address[1])
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._sock.close()
+
+    def _serve(self):
+        while True:
+            try:
+                (packet, address) = self._sock.recvfrom(2048)
+            except OSError:
+                return
+            self.received += 1
+            if self.offline or (self.loss and self._random.random() < self.loss):
+                self.dropped += 1
+                continue
+            response = self._handle(packet)
+            if response is None:
+                continue
+            delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self._sock.sendto(response, address)
+            except OSError:
+                return
+            self.answered += 1
+
+    def _handle(self, packet):
+        if len(packet) == 0x30 and packet[0x26] == 0x06:
+            return self._hello()
+        if len(packet) < 0x38 or packet[0x00:0x08] != HEADER:
+            return None
+        packet_type = int.from_bytes(packet[0x26:0x28], 'little')
+        key = INIT_KEY if packet_type == 0x65 else self.key
+        payload = self._crypt(key, packet[0x38:], decrypt=True)
+        if packet_type == 0x65:
+            # auth: hands out the session id and key
+            reply = self.id.to_bytes(4, 'little') + self.key + bytes(12)
+            return self._response(packet, 0x3e9, INIT_KEY, reply)
+        if packet_type == 0x6a:
+            command = payload[0]
+            if command == 0x02:
+                self.codes += 1
+                # like the real devices, sending ends the learning mode
+                self.learning = False
+            reply = bytearray(16)
+            reply[0] = command
+            if command == 0x68:
+                # firmware version
+                reply[4:6] = (55).to_bytes(2, 'little')
+            elif command in (0x03, 0x1b):
+                # enter_learning, find_rf_packet
+                self.learning = True
+            elif command == 0x04:
+                # check_data
+                if not self.learning or not self.learned:
+                    return self._response(packet, 0x3ee, self.key, reply, READ_ERROR)
+                self.learning = False
+                reply = reply[:4] + self.learned
+            elif command == 0x1a:
+                # check_frequency
+                reply[4] = 1 if self.learned else 0
+            return self._response(packet, 0x3ee, self.key, reply)
+        return self._response(packet, 0x3ee, self.key, bytes(16))
+
+    def _hello(self):
+        response = bytearray(0x80)
+        response[0x34:0x36] = self.devtype.to_bytes(2, 'little')
+        response[0x3a:0x40] = self.mac[::-1]
+        name = self.name.encode('UTF-8')[:0x3e]
+        response[0x40:0x40 + len(name)] = name
+        response[0x20:0x22] = checksum(response).to_bytes(2, 'little')
+        return bytes(response)
+
+    def _response(self, request, packet_type, key, payload, error=0):
+        response = bytearray(0x38)
+        response[0x00:0x08] = HEADER
+        response[0x22:0x24] = error.to_bytes(2, 'little', signed=True)
+        response[0x24:0x26] = self.devtype.to_bytes(2, 'little')
+        response[0x26:0x28] = packet_type.to_bytes(2, 'little')
+        # the count of the request, which is how acks are matched
+        response[0x28:0x2a] = request[0x28:0x2a]
+        response[0x2a:0x30] = self.mac[::-1]
+        response[0x30:0x34] = self.id.to_bytes(4, 'little')
+        response += self._crypt(key, payload)
+        response[0x20:0x22] = checksum(response).to_bytes(2, 'little')
+        return bytes(response)
+
+    def _crypt(self, key, data, decrypt=False):
+        cipher = Cipher(algorithms.AES(key), modes.CBC(INIT_VECT), backend=default_backend())
+        context = cipher.decryptor() if decrypt else cipher.encryptor()
+        data = bytes(data) + bytes(-len(data) % 16)
+        return context.update(data) + context.finalize()
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated Broadlink RM device')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=80)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds')
+    parser.add_argument('--jitter', type=float, default=0, help='milliseconds')
+    parser.add_argument('--loss', type=float, default=0, help='probability (0-1)')
+    args = parser.parse_args()
+
+    device = FakeDevice(args.host, args.port, latency=args.latency / 1000, jitter=args.jitter / 1000,
+                        loss=args.loss).start()
+    print('Fake device %s listening on %s:%s' % (device.mac.hex(), *device.address))
+    try:
+        while True:
+            time.sleep(10)
+            print('received: %s, answered: %s, dropped: %s, codes: %s' %
+                  (device.received, device.answered, device.dropped, device.codes))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
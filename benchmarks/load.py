@@ -0,0 +1,218 @@
+# Load test of the HTTP, LIRC and MQTT front ends against simulated devices
+# (see fakedevice.py) and a local broker stand-in (see fakebroker.py), run with:
+#   python benchmarks/load.py [--clients N] [--devices M] [--requests R] ...
+import argparse
+import base64
+import collections
+import http.client
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import warnings
+import paho.mqtt.client as mqtt_client
+from broadlink_bridge import LOGGER, REGISTRY, codec
+from broadlink_bridge.http import httpd_start
+from broadlink_bridge.lirc import lircd_start
+from broadlink_bridge.mqtt import mqtt_connect
+from fakebroker import Broker
+from fakedevice import FakeDevice
+
+# NEC-like code, as sent by most TV remotes
+PRONTO = ('0000 006D 0022 0000 0156 00AB ' + '0015 0015 0015 0040 ' * 16 + '0015 05ED').strip()
+CODE   = base64.b64encode(codec.pronto_to_broadlink(PRONTO.replace(' ', ''))).decode('US-ASCII')
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+def run_clients(clients, function):
+    # every client runs function(client, latencies, errors) in its own
+    # thread, all starting at the same time
+    barrier = threading.Barrier(clients + 1)
+    latencies = []
+    errors = []
+    def client(i):
+        (mine, failed) = ([], [])
+        barrier.wait()
+        function(i, mine, failed)
+        latencies.extend(mine)
+        errors.extend(failed)
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return (time.perf_counter() - start, sorted(latencies), errors)
+
+def device_name(args, client, i):
+    return 'dev%d' % ((client + i) % args.devices)
+
+def http_client(args, port):
+    def run(client, latencies, errors):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=args.timeout)
+        for i in range(args.requests):
+            start = time.perf_counter()
+            try:
+                conn.request('POST', '/device/' + device_name(args, client, i), body=CODE)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 204:
+                    errors.append(response.status)
+                    continue
+            except OSError as e:
+                errors.append(e)
+                conn.close()
+                continue
+            latencies.append(time.perf_counter() - start)
+        conn.close()
+    return run
+
+def lirc_client(args, port):
+    def run(client, latencies, errors):
+        sock = socket.create_connection(('127.0.0.1', port), timeout=args.timeout)
+        buffer = b''
+        for i in range(args.requests):
+            start = time.perf_counter()
+            try:
+                sock.sendall(('SEND_ONCE %s %s\n' % (device_name(args, client, i), CODE)).encode('US-ASCII'))
+                while b'END\n' not in buffer:
+                    data = sock.recv(4096)
+                    if not data:
+                        raise ConnectionError('Connection closed')
+                    buffer += data
+                (reply, buffer) = buffer.split(b'END\n', 1)
+                if b'SUCCESS' not in reply:
+                    errors.append(reply)
+                    continue
+            except OSError as e:
+                errors.append(e)
+                break
+            latencies.append(time.perf_counter() - start)
+        sock.close()
+    return run
+
+def mqtt_client_factory(args, broker):
+    # results are published per device in the order the codes were sent, so
+    # requests are matched to results first-in first-out per topic
+    pending = collections.defaultdict(collections.deque)
+    lock = threading.Lock()
+    def on_message(client, userdata, msg):
+        with lock:
+            queue = pending.get(msg.topic[:-len('/result')])
+            request = queue.popleft() if queue else None
+        if request:
+            request['status'] = json.loads(msg.payload).get('status')
+            request['event'].set()
+    listener = mqtt_client.Client()
+    listener.on_message = on_message
+    listener.connect(*broker.server_address)
+    listener.subscribe('broadlink/device/+/transmit/result')
+    listener.loop_start()
+
+    def run(client, latencies, errors):
+        publisher = mqtt_client.Client()
+        publisher.connect(*broker.server_address)
+        publisher.loop_start()
+        for i in range(args.requests):
+            topic = 'broadlink/device/%s/transmit' % device_name(args, client, i)
+            request = {'event': threading.Event(), 'status': None}
+            start = time.perf_counter()
+            with lock:
+                pending[topic].append(request)
+            publisher.publish(topic, CODE)
+            if not request['event'].wait(args.timeout):
+                errors.append('timeout')
+                with lock:
+                    if request in pending[topic]:
+                        pending[topic].remove(request)
+                continue
+            if request['status'] != 'succeeded':
+                errors.append(request['status'])
+                continue
+            latencies.append(time.perf_counter() - start)
+        publisher.loop_stop()
+        publisher.disconnect()
+    return run
+
+def setup_devices(args):
+    devices = []
+    for i in range(args.devices):
+        devices.append(FakeDevice(latency=args.latency / 1000, jitter=args.jitter / 1000, loss=args.loss,
+                                  offline=i < args.offline).start())
+    # the devices are "known from a previous run", so that no hello/auth
+    # round trip (which always goes to port 80) is needed
+    state = {'devices': [dict(device.state, alias='dev%d' % i) for (i, device) in enumerate(devices)]}
+    (fd, path) = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    REGISTRY.queue_size = args.clients * args.requests
+    REGISTRY.ack_timeout = args.ack_timeout / 1000
+    REGISTRY.load_state(path)
+    REGISTRY.state_file = None
+    os.unlink(path)
+    return devices
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the bridge front ends')
+    parser.add_argument('--frontend', choices=('http', 'lirc', 'mqtt', 'all'), default='all')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--devices', type=int, default=4, help='simulated devices')
+    parser.add_argument('--requests', type=int, default=200, help='requests per client')
+    parser.add_argument('--latency', type=float, default=2, help='device latency in milliseconds')
+    parser.add_argument('--jitter', type=float, default=1, help='device latency jitter in milliseconds')
+    parser.add_argument('--loss', type=float, default=0, help='probability of a lost packet (0-1)')
+    parser.add_argument('--offline', type=int, default=0, help='number of devices that never answer')
+    parser.add_argument('--ack-timeout', type=float, default=200, help='bridge ack timeout in milliseconds')
+    parser.add_argument('--timeout', type=float, default=10, help='client timeout in seconds')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+    LOGGER.setLevel(logging.DEBUG if args.verbose else logging.ERROR)
+    # paho-mqtt 2.x warns about the callback API version
+    warnings.simplefilter('ignore', DeprecationWarning)
+
+    devices = setup_devices(args)
+    frontends = []
+    if args.frontend in ('http', 'all'):
+        port = free_port()
+        httpd_start(port, workers=args.clients * 2)
+        frontends.append(('http', http_client(args, port)))
+    if args.frontend in ('lirc', 'all'):
+        port = free_port()
+        lircd_start(port, workers=args.clients * 2)
+        frontends.append(('lirc', lirc_client(args, port)))
+    if args.frontend in ('mqtt', 'all'):
+        broker = Broker().start()
+        mqtt_connect(broker.url, results=True, workers=args.clients, queue_size=args.clients * args.requests)
+        time.sleep(0.5)
+        frontends.append(('mqtt', mqtt_client_factory(args, broker)))
+
+    print('%d clients x %d requests, %d devices (latency %s±%s ms, loss %s, offline %d)' %
+          (args.clients, args.requests, args.devices, args.latency, args.jitter, args.loss, args.offline))
+    print('%-6s %8s %7s %8s %10s %9s %9s %9s' % ('', 'requests', 'errors', 'seconds', 'req/s', 'p50 ms', 'p99 ms', 'max ms'))
+    for (name, function) in frontends:
+        (seconds, latencies, errors) = run_clients(args.clients, function)
+        total = len(latencies) + len(errors)
+        print('%-6s %8d %7d %8.2f %10.1f %9.2f %9.2f %9.2f' %
+              (name, total, len(errors), seconds, total / seconds,
+               percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+               (latencies[-1] if latencies else float('nan')) * 1000))
+    print('device packets: %d received, %d answered, %d dropped, %d codes' % (
+        sum(device.received for device in devices), sum(device.answered for device in devices),
+        sum(device.dropped for device in devices), sum(device.codes for device in devices)))
+
+if __name__ == '__main__':
+    main()
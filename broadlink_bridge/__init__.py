@@ -1,6 +1,18 @@
+import base64
 import broadlink
+import collections
+import concurrent.futures
+import json
 import logging
+import os
 import pkg_resources
+import threading
+import time
+import uuid
+from . import codec
+from .library import CommandLibrary
+from .metrics import Metrics
+from .transport import Transport
 from .util import *
 
 NAME    = 'broadlink-bridge'
@@ -8,12 +20,65 @@ VERSION = pkg_resources.get_distribution(NAME).version
 SERVER  = NAME + '/' + VERSION
 LOGGER  = logging.getLogger(__name__)
 
+# transmit priority classes, most urgent first: a queued code is sent before
+# any code of a lower class, whenever it was queued
+PRIORITIES = ('interactive', 'normal', 'bulk')
+
+def check_priority(priority):
+    if priority not in PRIORITIES:
+        raise ValueError('Unknown priority: %s' % priority)
+    return priority
+
+class TransmitError(Exception):
+    pass
+
+class QueueFullError(TransmitError):
+    pass
+
+class DeviceUnavailableError(TransmitError):
+    pass
+
+class LearnError(TransmitError):
+    pass
+
+class DeviceNotFoundError(LookupError):
+    pass
+
 class Registry:
     def __init__(self):
         self._device_types = {}
         self._devices = []
         self._devices_by_alias = {}
+        self._devices_by_address = {}
+        self._addresses_of = {}
+        self._unknown = {}
+        self._lock = threading.RLock()
         self._commands = {}
+        self._sequences = {}
+        self._library = CommandLibrary()
+        self._groups = {}
+        self._jobs = collections.OrderedDict()
+        self.job_history = 1000
+        self.queue_size = 32
+        self.rate_limit = 0
+        self.rate_burst = 5
+        self.coalesce = None
+        self.coalesce_window = 0.3
+        self.repeat_chunk = 0.2
+        self.repeat_timeout = 30
+        self.learn_timeout = 30
+        self.learn_interval = 0.5
+        self.negative_cache_ttl = 60
+        self.state_file = None
+        self.connect_timeout = 5
+        self.connect_workers = 8
+        self.ack_timeout = 1
+        self.send_attempts = 3
+        self.health_interval = 60
+        self.backoff_min = 1
+        self.backoff_max = 300
+        self.queue_when_down = False
+        self._discovering = False
 
     def add_device_type(self, type_id, implementation_class, device_name, manufacturer):
         self._device_types[type_id] = (implementation_class, device_name, manufacturer)
@@ -24,31 +89,171 @@ class Registry:
     def get_device_type(self, type_id):
         return self._device_types[type_id]
 
-    def add_manual_device(self, host, alias=None):
-        return self._add_device(host, alias)
+    def add_manual_devices(self, devices):
+        pending = []
+        for (alias, host) in devices:
+            device = self._devices_by_alias.get(alias)
+            if device and device.host == host:
+                LOGGER.debug('Device: %s already known from state file', device)
+                continue
+            device = self._add_device(Device(host, connect=False), alias)
+            if device:
+                pending.append(device)
+        if not pending:
+            return
+
+        # devices are registered right away as pending and connected
+        # concurrently, so that an offline device does not delay the others
+        pool = concurrent.futures.ThreadPoolExecutor(self.connect_workers, thread_name_prefix='connect')
+        for device in pending:
+            pool.submit(self._connect_pending, device)
+        pool.shutdown(wait=False)
+
+    def set_manual_devices(self, devices):
+        # the configuration is the authority over aliases: a device declared
+        # before or restored from the state file under an alias that is no
+        # longer configured, or now configured with another host, is removed.
+        # Only the differences are applied: devices that are kept do not lose
+        # their connection or their transmit queue
+        devices = dict(devices)
+        with self._lock:
+            aliases = [(alias, device) for (alias, device) in self._devices_by_alias.items() if alias != device.host]
+        for (alias, device) in aliases:
+            if devices.get(alias) != device.host:
+                self.remove_device(alias)
+        self.add_manual_devices(list(devices.items()))
+
+    def remove_device(self, alias):
+        with self._lock:
+            device = self._devices_by_alias.pop(alias, None)
+            if not device or device in self._devices_by_alias.values():
+                return device
+            self._devices.remove(device)
+            for address in self._addresses_of.pop(device, ()):
+                if self._devices_by_address.get(address) is device:
+                    del self._devices_by_address[address]
+            LOGGER.info('Device: %s removed (alias %s)', device, alias)
+            self.save_state()
+        device.close()
+        return device
+
+    def configure_transports(self):
+        # devices copy these settings when they are created
+        for device in list(self._devices):
+            device._transport.configure(self.ack_timeout, self.send_attempts)
+
+    def _connect_pending(self, device):
+        if not device.connect():
+            LOGGER.warning('Device: %s did not answer within %s seconds, will retry in the background',
+                           device, self.connect_timeout)
+
+    def check_health(self):
+        now = time.monotonic()
+        for device in list(self._devices):
+            if device.check_due(now):
+                SCHEDULER.call_soon(device.check)
+
+    def load_state(self, path):
+        self.state_file = path
+        if not path or not os.path.exists(path):
+            return False
+        LOGGER.info('Reading state file: %s', path)
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            LOGGER.warning('Ignoring unreadable state file %s: %s', path, e)
+            return False
+        for entry in state.get('devices', []):
+            try:
+                device = Device(entry['host'], connect=False)
+                device.restore(entry)
+            except (KeyError, TypeError, ValueError) as e:
+                LOGGER.warning('Ignoring invalid device in state file: %s (%s)', entry, e)
+                continue
+            self._add_device(device, entry.get('alias'))
+        return True
+
+    def save_state(self):
+        if not self.state_file:
+            return
+        with self._lock:
+            aliases = {device: alias for (alias, device) in self._devices_by_alias.items()}
+            devices = []
+            for device in self._devices:
+                entry = device.state
+                if entry:
+                    entry['alias'] = aliases.get(device)
+                    devices.append(entry)
+            temp = self.state_file + '.tmp'
+            try:
+                # holds the session keys of the devices: only for the owner
+                with open(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                    json.dump({'devices': devices}, f, indent=2)
+                os.replace(temp, self.state_file)
+            except OSError as e:
+                LOGGER.warning('Could not write state file %s: %s', self.state_file, e)
+
+    def revalidate(self):
+        for device in list(self._devices):
+            if device.restored:
+                SCHEDULER.call_soon(device.reconnect)
 
     def discover(self, timeout=None):
         if not timeout or timeout <= 0:
             LOGGER.info('Discovery disabled')
             return False
-        
-        LOGGER.info("Discovery: searching for devices for %s seconds...", timeout)
-        devices = broadlink.discover(timeout=timeout)
-        if not isinstance(devices, list):
-            devices = [devices]
-        for dev in devices:
-            dev = self._add_device(dev)
+        with self._lock:
+            if self._discovering:
+                LOGGER.debug('Discovery: already running')
+                return False
+            self._discovering = True
+
+        try:
+            LOGGER.info("Discovery: searching for devices for %s seconds...", timeout)
+            start = time.monotonic()
+            devices = broadlink.discover(timeout=timeout)
+            if not isinstance(devices, list):
+                devices = [devices]
+            new = 0
+            updated = 0
+            for dev in devices:
+                # results are merged by MAC: known devices are updated in
+                # place, only unknown ones are registered
+                device = self._devices_by_address.get(mac_format(dev.mac))
+                if device:
+                    if device.update_address(dev):
+                        updated += 1
+                elif self._add_device(dev):
+                    new += 1
+            duration = time.monotonic() - start
+            DISCOVERY_TIME.observe(duration)
+            LOGGER.info('Discovery: found %s devices (%s new, %s updated) in %.1f seconds',
+                        len(devices), new, updated, duration)
+        finally:
+            self._discovering = False
         return True if self._devices else False
 
     def get_devices(self):
         return self._devices
     
     def find_device(self, id):
+        start = time.monotonic()
+        try:
+            return self._find_device(id)
+        finally:
+            LOOKUP_TIME.observe(time.monotonic() - start)
+
+    def _find_device(self, id):
         LOGGER.debug('Finding device: %s...', id)
         device = self._devices_by_alias.get(id)
         if device:
             LOGGER.debug('Found device by alias: %s', device)
             return device
+        group = self._groups.get(id)
+        if group:
+            LOGGER.debug('Found group: %s', group)
+            return group
         elif id == 'default':
             if self._devices:
                 device = self._devices[0]
@@ -56,30 +261,206 @@ class Registry:
                 return device
         else:
             mac = mac_format(id)
-            for device in self._devices:
-                if mac == device.mac or id == device.host or id in device.addresses:
-                    LOGGER.debug('Found device by address: %s', device)
-                    return device
-            LOGGER.debug('Checking if device exists at address: %s', id)
-            device = Device(id)
-            if device.connect():
-                LOGGER.debug('Found device %s, registering', device)
-                self._add_device(device)
+            device = self._devices_by_address.get(mac or id)
+            if device:
+                LOGGER.debug('Found device by address: %s', device)
                 return device
+            if not mac:
+                self._probe_later(id)
         LOGGER.debug('Device not found.')
         return None
 
+    def _probe_later(self, id):
+        # unknown hosts are probed in the background, so that requests fail
+        # fast instead of waiting for a network timeout
+        with self._lock:
+            expiry = self._unknown.get(id)
+            if expiry is not None and (expiry is True or expiry > time.monotonic()):
+                return
+            self._unknown[id] = True
+        SCHEDULER.call_soon(self._probe, id)
+
+    def _probe(self, id):
+        LOGGER.debug('Checking if device exists at address: %s', id)
+        device = Device(id)
+        if device.connect():
+            LOGGER.info('Found device %s, registering', device)
+            self._add_device(device)
+            with self._lock:
+                self._unknown.pop(id, None)
+        else:
+            LOGGER.debug('No device at address: %s', id)
+            with self._lock:
+                self._unknown[id] = time.monotonic() + self.negative_cache_ttl
+
+    def _index_device(self, device):
+        with self._lock:
+            if device not in self._addresses_of:
+                return
+            addresses = {device.host}
+            if device.connected:
+                addresses.add(device.mac)
+                addresses.update(device.addresses)
+            for address in self._addresses_of[device] - addresses:
+                if self._devices_by_address.get(address) is device:
+                    del self._devices_by_address[address]
+            for address in addresses:
+                self._devices_by_address.setdefault(address, device)
+                self._unknown.pop(address, None)
+            self._addresses_of[device] = addresses
+
+    def _device_connected(self, device):
+        if device in self._addresses_of:
+            self._index_device(device)
+            self.save_state()
+
     def set_command(self, command, data):
         if ' ' in command:
             raise ValueError('Commands cannot contain spaces: ' + command)
         LOGGER.info('Registering command: %s', command)
-        self._commands[command] = ir_decode(data)[0]
+        code = ir_decode(data)[0]
+        if not isinstance(data, str):
+            code = NORMALIZER(code)
+        with self._lock:
+            self._commands[command] = code
 
-    def get_commands(self):
-        return self._commands.keys()
-    
-    def get_command(self, command):
-        return self._commands.get(command)
+    def set_commands(self, commands, sequences, library=None):
+        self.install_commands(self.prepare_commands(commands, sequences, library))
+
+    def prepare_commands(self, commands, sequences, library=None):
+        # everything is decoded before anything is swapped in, so that a
+        # transmit never sees a half-applied configuration; an invalid entry
+        # raises ValueError and leaves the current commands in place
+        library = self._library if library is None else library
+        new_commands = {}
+        for (command, data) in commands:
+            if ' ' in command:
+                raise ValueError('Commands cannot contain spaces: ' + command)
+            new_commands[command] = ir_decode(data)[0]
+        new_sequences = {}
+        for (name, steps) in sequences:
+            if ' ' in name:
+                raise ValueError('Sequences cannot contain spaces: ' + name)
+            new_sequences[name] = [step._replace(code=self.decode(step.code, step.repeat, new_commands, library)[0],
+                                                 repeat=None)
+                                   for step in steps]
+        return (new_commands, new_sequences, library)
+
+    def install_commands(self, prepared):
+        (new_commands, new_sequences, library) = prepared
+        with self._lock:
+            (old_commands, self._commands) = (self._commands, new_commands)
+            (old_sequences, self._sequences) = (self._sequences, new_sequences)
+            self._library = library
+        for (kind, old, new) in (('command', old_commands, new_commands), ('sequence', old_sequences, new_sequences)):
+            added = new.keys() - old.keys()
+            removed = old.keys() - new.keys()
+            changed = [name for name in new.keys() & old.keys() if new[name] != old[name]]
+            if added or removed or changed:
+                LOGGER.info('Registered %ss: %s added, %s removed, %s changed (%s total)',
+                            kind, len(added), len(removed), len(changed), len(new))
+
+    def set_groups(self, groups):
+        self.install_groups(self.prepare_groups(groups))
+
+    def prepare_groups(self, groups, devices=None):
+        # with devices, names are checked against the aliases that will exist
+        # once those manually declared devices replace the current ones
+        aliases = set(self._devices_by_alias)
+        if devices is not None:
+            aliases = {alias for (alias, device) in self._devices_by_alias.items() if alias == device.host}
+            aliases |= set(dict(devices))
+        new_groups = {}
+        for (name, members) in groups:
+            if isinstance(members, str):
+                members = [member.strip() for member in members.replace(',', ' ').split()]
+            if not members:
+                raise ValueError('Group has no members: ' + name)
+            if name in aliases:
+                raise ValueError('Group name is already a device alias: ' + name)
+            new_groups[name] = Group(name, members)
+        for group in new_groups.values():
+            nested = [member for member in group.members if member in new_groups]
+            if nested:
+                raise ValueError('Groups cannot contain groups: %s (%s)' % (group, ', '.join(nested)))
+        return new_groups
+
+    def install_groups(self, new_groups):
+        self._groups = new_groups
+        for group in new_groups.values():
+            LOGGER.info('Registering group: %s (%s)', group, ', '.join(group.members))
+
+    def get_groups(self):
+        return self._groups.keys()
+
+    def get_commands(self, prefix=''):
+        commands = sorted(command for command in self._commands if command.startswith(prefix))
+        return commands + [command for command in self._library.names(prefix) if command not in self._commands]
+
+    def decode(self, code, repeat=None, commands=None, library=None):
+        if not isinstance(code, str):
+            code = code.decode('US-ASCII')
+
+        (code, repeat) = ir_decode_multiply(code, repeat)
+        command_code = (self._commands if commands is None else commands).get(code)
+        if command_code is None:
+            # library codes are decoded on first use, then served from the
+            # decode cache
+            command_code = (self._library if library is None else library).get(code)
+        if command_code:
+            code = command_code
+        start = time.monotonic()
+        try:
+            return ir_decode(code, repeat=repeat)
+        finally:
+            DECODE_TIME.observe(time.monotonic() - start)
+
+    def get_sequences(self):
+        return self._sequences.keys()
+
+    def get_sequence(self, name):
+        return self._sequences.get(name)
+
+    def parse_sequence(self, payload):
+        # a payload is the name of a sequence, a JSON list of steps or steps
+        # in the same format as the configuration file
+        if not isinstance(payload, str):
+            payload = payload.decode('UTF-8')
+        payload = payload.strip()
+        steps = self.get_sequence(payload)
+        if steps:
+            return steps
+        if payload.startswith('['):
+            return parse_sequence_json(payload)
+        return parse_sequence(payload)
+
+    def run_sequence(self, steps, callback=None, priority='normal'):
+        # resolves and decodes everything up front, so that an invalid
+        # sequence is rejected before any step is sent
+        resolved = []
+        for step in steps:
+            device = self.find_device(step.device)
+            if not device:
+                raise DeviceNotFoundError('Device not found: ' + step.device)
+            code = step.code
+            if isinstance(code, str):
+                code = self.decode(code, step.repeat)[0]
+            resolved.append((device, code, step.delay))
+        run = SequenceRun(resolved, callback, priority)
+        self.add_job(run)
+        run.start()
+        return run
+
+    def add_job(self, job):
+        # recent jobs are kept so that their outcome can be queried later
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.job_history:
+                self._jobs.popitem(last=False)
+        return job
+
+    def get_job(self, id):
+        return self._jobs.get(id)
 
     def _add_device(self, dev, alias=None):
         if not isinstance(dev, Device):
@@ -87,101 +468,988 @@ class Registry:
         if not alias:
             alias = dev.host
         
-        if alias not in self._devices_by_alias:
-            LOGGER.info('Device: %s has alias %s', dev, alias)
-            self._devices.append(dev)
-            self._devices_by_alias[alias] = dev
-            return dev
+        with self._lock:
+            if alias not in self._devices_by_alias:
+                LOGGER.info('Device: %s has alias %s', dev, alias)
+                self._devices.append(dev)
+                self._devices_by_alias[alias] = dev
+                self._addresses_of[dev] = set()
+                self._index_device(dev)
+                if dev.connected:
+                    self.save_state()
+                return dev
+        LOGGER.info('Device: %s skipped, alias %s already exists', dev, alias)
+        return None
+
+class Job:
+    def __init__(self, device, code, callback=None, coalesce=True, priority='normal'):
+        self.id = uuid.uuid4().hex
+        self.device = device
+        self.code = code
+        self.coalesce = coalesce
+        self.priority = priority
+        self.level = PRIORITIES.index(check_priority(priority))
+        self.created_at = time.time()
+        self.created = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.callback = callback
+        self.merged = []
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def wait_time(self):
+        if self.started is None:
+            return time.monotonic() - self.created
+        return self.started - self.created
+
+    @property
+    def status(self):
+        if self.finished is not None:
+            return 'succeeded' if self.result and not self.error else 'failed'
+        return 'queued' if self.started is None else 'running'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device': str(self.device),
+            'status': self.status,
+            'priority': self.priority,
+            'created': self.created_at,
+            'wait_time': self.wait_time,
+            'duration': self.finished - self.started if self.finished is not None else None,
+            'error': str(self.error) if self.error else None,
+        }
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TransmitError('Timed out waiting for transmit to %s' % self.device)
+        if self.error:
+            raise self.error
+        return self.result
+
+    def _finish(self, result=None, error=None):
+        self.finished = time.monotonic()
+        self.result = result
+        self.error = error
+        self._done.set()
+        if self.callback:
+            try:
+                self.callback(self)
+            except Exception:
+                LOGGER.exception('Transmit callback failed for %s', self.device)
+
+class SequenceRun:
+    def __init__(self, steps, callback=None, priority='normal'):
+        self.id = uuid.uuid4().hex
+        self.created_at = time.time()
+        self.callback = callback
+        self.priority = priority
+        self.steps = steps
+        self.jobs = [None] * len(steps)
+        self.errors = [None] * len(steps)
+        # offset of each step from the start, and the next step for the same
+        # device, which is only scheduled once this one is done
+        self._offsets = []
+        self._next = [None] * len(steps)
+        self._start = None
+        self._pending = len(steps)
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def start(self):
+        # steps are handed to the device queues at their scheduled time: steps
+        # for different devices run in parallel, steps for the same device
+        # stay in order and a wait between them counts from when the previous
+        # one was actually sent, however long it waited in the queue
+        self._start = time.monotonic()
+        offset = 0
+        last = {}
+        for (i, (device, code, delay)) in enumerate(self.steps):
+            offset += delay / 1000
+            self._offsets.append(offset)
+            if device in last:
+                self._next[last[device]] = i
+            else:
+                TIMER.call_at(self._start + offset, self._dispatch, i)
+            last[device] = i
+
+    def _dispatch(self, i):
+        (device, code, delay) = self.steps[i]
+        try:
+            # repeated steps are intended (e.g. menu navigation), so they are
+            # never merged or dropped by coalescing
+            self.jobs[i] = device.submit(code, callback=lambda job: self._finish(i, job.error),
+                                         coalesce=False, priority=self.priority)
+        except TransmitError as e:
+            LOGGER.warning('Sequence step %s for %s failed: %s', i + 1, device, e)
+            self._finish(i, e)
+
+    def _finish(self, i, error):
+        if error:
+            self.errors[i] = error
+        following = self._next[i]
+        if following is not None:
+            delay = self._offsets[following] - self._offsets[i]
+            TIMER.call_at(max(self._start + self._offsets[following], time.monotonic() + delay),
+                          self._dispatch, following)
+        with self._lock:
+            self._pending -= 1
+            if self._pending:
+                return
+        self._done.set()
+        if self.callback:
+            try:
+                self.callback(self)
+            except Exception:
+                LOGGER.exception('Sequence callback failed')
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def status(self):
+        if not self.done:
+            return 'running'
+        return 'failed' if any(self.errors) else 'succeeded'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'created': self.created_at,
+            'steps': [{
+                'device': str(device),
+                'status': self.jobs[i].status if self.jobs[i] else ('failed' if self.errors[i] else 'scheduled'),
+                'error': str(self.errors[i]) if self.errors[i] else None,
+            } for (i, (device, code, delay)) in enumerate(self.steps)],
+        }
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+class Group:
+    # a named set of devices that is addressed like a single device: the code
+    # is decoded once and queued to every member, which transmit in parallel
+    def __init__(self, name, members):
+        self.name = name
+        self.members = list(members)
+
+    def resolve(self):
+        return [(member, REGISTRY.find_device(member)) for member in self.members]
+
+    def transmit(self, code, repeat=None, wait=True, callback=None, priority='normal'):
+        (code, repeat) = REGISTRY.decode(code, repeat)
+        job = self.submit(code, callback, priority)
+        if not wait:
+            REGISTRY.add_job(job)
+            return job
+        job.wait()
+        return job
+
+    def submit(self, code, callback=None, coalesce=True, priority='normal'):
+        members = self.resolve()
+        job = GroupJob(self, len(members), callback)
+        for (member, device) in members:
+            if device is None:
+                job.add(member, None, DeviceNotFoundError('Device not found: ' + member))
+                continue
+            try:
+                job.add(member, device.submit(code, callback=job._member_done, coalesce=coalesce,
+                                              priority=priority))
+            except TransmitError as e:
+                job.add(member, None, e)
+        job.start()
+        return job
+
+    def start_repeat(self, code, repeat=None):
+        # decoded once up front so that a bad code fails before anything is
+        # started, the members then hit the decode cache
+        REGISTRY.decode(code, repeat)
+        runs = []
+        for (member, device) in self.resolve():
+            if device:
+                try:
+                    runs.append(device.start_repeat(code, repeat))
+                except TransmitError as e:
+                    LOGGER.warning('Repeat for group %s: %s', self, e)
+        if not runs:
+            raise TransmitError('No member of %s can transmit' % self)
+        return runs
+
+    def stop_repeat(self, code=None):
+        stopped = [device.stop_repeat(code) for (member, device) in self.resolve() if device]
+        return any(stopped)
+
+    @property
+    def status(self):
+        statuses = [device.status if device else 'unknown' for (member, device) in self.resolve()]
+        if all(status == 'up' for status in statuses):
+            return 'up'
+        return 'degraded' if 'up' in statuses else 'down'
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return self.__str__()
+
+class GroupJob:
+    def __init__(self, group, size, callback=None):
+        self.id = uuid.uuid4().hex
+        self.group = group
+        self.created_at = time.time()
+        self.created = time.monotonic()
+        self.callback = callback
+        self.members = []
+        # one more than the members, so that the job cannot finish while
+        # members are still being added
+        self._pending = size + 1
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def add(self, member, job, error=None):
+        with self._lock:
+            self.members.append((member, job, error))
+        if not job:
+            self._member_done(None)
+
+    def start(self):
+        self._member_done(None)
+
+    def _member_done(self, job):
+        with self._lock:
+            self._pending -= 1
+            if self._pending:
+                return
+        self._done.set()
+        if self.callback:
+            try:
+                self.callback(self)
+            except Exception:
+                LOGGER.exception('Group callback failed for %s', self.group)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def errors(self):
+        return [error or job.error for (member, job, error) in self.members
+                if error or (job and job.done and (job.error or not job.result))]
+
+    @property
+    def error(self):
+        errors = self.errors
+        if not errors:
+            return None
+        return errors[0] if len(errors) == 1 else TransmitError('%s of %s members failed' % (len(errors), len(self.members)))
+
+    @property
+    def result(self):
+        return self.done and not self.errors
+
+    @property
+    def status(self):
+        if not self.done:
+            return 'running'
+        failed = len(self.errors)
+        if not failed:
+            return 'succeeded'
+        return 'failed' if failed == len(self.members) else 'partial'
+
+    def to_dict(self):
+        members = []
+        for (member, job, error) in self.members:
+            members.append({
+                'member': member,
+                'device': str(job.device) if job else None,
+                'status': job.status if job else 'rejected',
+                'latency': job.finished - job.created if job and job.finished is not None else None,
+                'error': str(error or job.error) if error or (job and job.error) else None,
+            })
+        return {
+            'id': self.id,
+            'group': str(self.group),
+            'status': self.status,
+            'created': self.created_at,
+            'members': members,
+        }
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+class RepeatRun:
+    # sends a code continuously (e.g. while a button is held) as a chain of
+    # packets, each repeating the code for about repeat_chunk seconds; a new
+    # packet is queued when the previous one is about to end, so stopping
+    # takes effect within one chunk
+    def __init__(self, device, code):
+        self.device = device
+        self.code = code
+        duration = codec.broadlink_duration(code) * (code[1] + 1) / 1e6
+        if duration <= 0:
+            raise ValueError('Code has no duration')
+        repeat = max(0, min(0xff, int(round(REGISTRY.repeat_chunk / duration)) - 1))
+        self.packet = bytearray(code)
+        self.packet[1] = repeat
+        self.packet = bytes(self.packet)
+        self.interval = duration * (repeat + 1)
+        self.chunks = 0
+        self.skipped = 0
+        self.active = False
+        self._job = None
+        self._deadline = None
+
+    def start(self):
+        self.active = True
+        now = time.monotonic()
+        self._deadline = now + REGISTRY.repeat_timeout
+        self._tick(now)
+
+    def stop(self):
+        if self.active:
+            self.active = False
+            LOGGER.debug('Repeat stopped for %s after %s chunks (%s skipped)', self.device, self.chunks, self.skipped)
+
+    def _tick(self, when):
+        if not self.active:
+            return
+        if when >= self._deadline:
+            LOGGER.warning('Repeat for %s stopped after %s seconds without a stop', self.device, REGISTRY.repeat_timeout)
+            self.device.stop_repeat()
+            return
+        if self._job and not self._job.done:
+            # the device is behind, a chunk is dropped rather than queued
+            self.skipped += 1
         else:
-            LOGGER.info('Device: %s skipped, alias %s already exists', dev, alias)
+            try:
+                # a held button is as urgent as it gets
+                self._job = self.device.submit(self.packet, coalesce=False, priority='interactive')
+                self.chunks += 1
+            except TransmitError as e:
+                LOGGER.warning('Repeat for %s stopped: %s', self.device, e)
+                self.device.stop_repeat()
+                return
+        TIMER.call_at(when + self.interval, self._tick, when + self.interval)
+
+class LearnSession:
+    # captures a code from a physical remote: the device is put in learning
+    # mode and then polled on the scheduler, so that a waiting session holds
+    # no thread; RF codes first need a frequency sweep (RM pro models)
+    def __init__(self, device, type='ir', name=None, callback=None):
+        self.id = uuid.uuid4().hex
+        self.device = device
+        self.type = type
+        self.name = name
+        self.callback = callback
+        self.created_at = time.time()
+        self.state = 'starting'
+        self.code = None
+        self.error = None
+        self._sent = None
+        self._deadline = None
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def status(self):
+        return self.state
+
+    @property
+    def pronto(self):
+        if not self.code or self.code[0] != codec.TYPE_IR:
             return None
+        return codec.broadlink_to_pronto(self.code)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device': str(self.device),
+            'type': self.type,
+            'status': self.status,
+            'name': self.name,
+            'created': self.created_at,
+            'code': base64.b64encode(self.code).decode('US-ASCII') if self.code else None,
+            'pronto': self.pronto,
+            'error': str(self.error) if self.error else None,
+        }
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.code
+
+    def start(self):
+        self._deadline = time.monotonic() + REGISTRY.learn_timeout
+        SCHEDULER.call_soon(self._step)
+
+    def _step(self):
+        try:
+            if self.state == 'starting':
+                self._enter()
+            elif self.state == 'sweeping':
+                # the button is being held while the device finds the frequency
+                if self.device._learn_call('check_frequency'):
+                    self.device._learn_call('find_rf_packet')
+                    self.state = 'learning'
+            else:
+                if self.type == 'ir' and self.device.stats['sent'] != self._sent:
+                    # a transmit in the meantime ends the learning mode
+                    self._enter()
+                code = self._check()
+                if code:
+                    return self._finish(code)
+        except TransmitError as e:
+            return self._finish(error=e)
+        except Exception as e:
+            # whatever happens, the session ends so that the device can learn again
+            return self._finish(error=LearnError('Learning on %s failed: %s' % (self.device, e)))
+        if time.monotonic() >= self._deadline:
+            if self.type == 'rf':
+                try:
+                    self.device._learn_call('cancel_sweep_frequency')
+                except TransmitError:
+                    pass
+            return self._finish(error=TransmitError('No code received within %s seconds' % REGISTRY.learn_timeout))
+        SCHEDULER.call_later(REGISTRY.learn_interval, self._step)
+
+    def _enter(self):
+        self._sent = self.device.stats['sent']
+        if self.type == 'rf':
+            self.device._learn_call('sweep_frequency')
+            self.state = 'sweeping'
+        else:
+            self.device._learn_call('enter_learning')
+            self.state = 'learning'
+
+    def _check(self):
+        try:
+            return bytes(self.device._learn_call('check_data'))
+        except (broadlink.exceptions.ReadError, broadlink.exceptions.StorageError):
+            # nothing received yet
+            return None
+
+    def _finish(self, code=None, error=None):
+        if code and self.name:
+            try:
+                REGISTRY.set_command(self.name, code)
+            except Exception as e:
+                # the code is still reported, it just could not be saved
+                error = LearnError('Could not save learned code as %s: %s' % (self.name, e))
+        self.code = code
+        self.error = error
+        self.state = 'succeeded' if code and not error else 'failed'
+        if self.state == 'succeeded':
+            LOGGER.info('Learned %s code on %s', self.type.upper(), self.device)
+        else:
+            LOGGER.info('Learning on %s failed: %s', self.device, error)
+        self._done.set()
+        if self.callback:
+            try:
+                self.callback(self)
+            except Exception:
+                LOGGER.exception('Learn callback failed for %s', self.device)
 
 class Device:
-    def __init__(self, host=None):
+    def __init__(self, host=None, connect=True):
         self._host = None
         self._dev = None
+        self._discovered = None
+        self.restored = False
         self._mac = None
         self._addresses = None
+        self._status = 'pending'
+        self.status_since = time.time()
+        self.last_seen = None
+        self._failures = 0
+        self._next_check = time.monotonic() + REGISTRY.connect_timeout
+        self._checking = False
+        self._io_lock = threading.Lock()
+        self._transport = Transport(REGISTRY.ack_timeout, REGISTRY.send_attempts)
+        # one queue per priority class
+        self._queues = [collections.deque() for priority in PRIORITIES]
+        self._queue_cond = threading.Condition()
+        self._tokens = None
+        self._tokens_at = None
+        self._worker = None
+        self._closed = False
+        self._current = None
+        self._last_sent = None
+        self._repeat = None
+        self._learning = None
+        self._stats = {
+            'queued': 0,
+            'sent': 0,
+            'failed': 0,
+            'rejected': 0,
+            'coalesced': 0,
+            'debounced': 0,
+            'throttled': 0,
+            'preempted': 0,
+            'reconnects': 0,
+            'wait_time_last': 0.0,
+            'wait_time_max': 0.0,
+            'wait_time_total': 0.0,
+        }
 
         if isinstance(host, str):
             self._host = host
         elif isinstance(host, broadlink.device.Device):
             self._host = host.host[0]
+            self._discovered = host
         assert self._host
 
-        self.connect()
+        if connect:
+            self.connect()
 
     def connect(self):
-        if self._dev:
+        if self.connected:
             return True
-        else:
-            connected = False
+        return self.reconnect()
+
+    def reconnect(self):
+        if self._closed:
+            return False
+        # the last known handle is kept when the device does not answer, so
+        # that it can still be persisted
+        dev = self._open()
+        if dev:
+            if self._dev:
+                self._stats['reconnects'] += 1
+            self._attach(dev)
+            return True
+        self._set_down()
+        return False
+
+    def check_due(self, now):
+        if self._checking or now < self._next_check:
+            return False
+        if self.connected and not REGISTRY.health_interval:
+            return False
+        self._checking = True
+        return True
+
+    def check(self):
+        try:
+            if self.connected and self._ping():
+                LOGGER.debug('Health check passed: %s', self)
+                self._next_check = time.monotonic() + REGISTRY.health_interval
+            else:
+                self.reconnect()
+        finally:
+            self._checking = False
+
+    def _ping(self):
+        with self._io_lock:
             try:
-                self._dev = broadlink.hello(host=self.host)
-                if self._dev:
-                    connected = self._dev.auth()
-            except (socket.gaierror, socket.timeout):
+                self._dev.get_fwversion()
+            except (broadlink.exceptions.AuthenticationError,
+                    broadlink.exceptions.AuthorizationError,
+                    broadlink.exceptions.NetworkTimeoutError,
+                    OSError) as e:
+                LOGGER.warning('Health check failed: %s (%s)', self, e)
+                return False
+            except broadlink.exceptions.BroadlinkException:
+                # the device answered, it just does not support the query
                 pass
+        self.last_seen = time.time()
+        return True
 
-            if connected and self._dev.get_type() == 'Unknown':
-                type_id = self._dev.devtype
-                connected = False
-                self._dev = None
-                
-                LOGGER.warning('Device type %s unsupported by python-broadlink module', hex(type_id))
-                if REGISTRY.has_device_type(type_id) and type_id not in broadlink.SUPPORTED_TYPES:
-                    device_type = REGISTRY.get_device_type(type_id)
-                    broadlink.SUPPORTED_TYPES[type_id] = device_type
-                    LOGGER.warning('Trying configured device type %s: %s', type_id, device_type[2])
-                    return self.connect()
-
-            if self._dev and connected:
-                LOGGER.info("Connected: %s", self._dev)
-                self._mac = mac_format(self._dev.mac)
-                self._addresses = get_ip_addresses(self._dev.host[0])
-                return True
-            else:
-                self._dev = None
-                self._mac = None
-                self._addresses = None
-        return False
+    def _set_status(self, status):
+        with self._queue_cond:
+            if status != self._status:
+                LOGGER.info('Device: %s is %s (was %s)', self, status, self._status)
+                self._status = status
+                self.status_since = time.time()
+            self._queue_cond.notify_all()
+
+    def _set_down(self):
+        self._failures += 1
+        delay = min(REGISTRY.backoff_max, REGISTRY.backoff_min * 2 ** (self._failures - 1))
+        self._next_check = time.monotonic() + delay
+        if self._status == 'up':
+            self._set_status('down')
+        LOGGER.debug('Device: %s will be retried in %s seconds', self, delay)
+
+    def update_address(self, dev):
+        # called with a freshly discovered handle for this device
+        address = dev.host[0]
+        if self._dev and self._dev.host == dev.host and self.connected:
+            return False
+        LOGGER.info('Device: %s found at %s', self, address)
+        self._discovered = dev
+        if self._dev:
+            self._dev.host = dev.host
+        self._addresses = {address}
+        REGISTRY._device_connected(self)
+        if not self.connected:
+            SCHEDULER.call_soon(self.reconnect)
+        return True
+
+    def _open(self):
+        dev = None
+        connected = False
+        deadline = time.monotonic() + REGISTRY.connect_timeout
+        try:
+            # a handle from discovery is authenticated directly, skipping hello
+            (dev, self._discovered) = (self._discovered, None)
+            if not dev:
+                dev = broadlink.hello(host=self.host, timeout=REGISTRY.connect_timeout)
+            if dev:
+                # authentication gets whatever is left of the deadline
+                timeout = dev.timeout
+                dev.timeout = max(deadline - time.monotonic(), 0.1)
+                connected = dev.auth()
+                dev.timeout = timeout
+        except (OSError, broadlink.exceptions.BroadlinkException):
+            pass
+
+        if connected and dev.get_type() == 'Unknown':
+            type_id = dev.devtype
+            LOGGER.warning('Device type %s unsupported by python-broadlink module', hex(type_id))
+            supported = any(type_id in products for products in broadlink.SUPPORTED_TYPES.values())
+            if REGISTRY.has_device_type(type_id) and not supported:
+                (cls, name, manufacturer) = REGISTRY.get_device_type(type_id)
+                broadlink.SUPPORTED_TYPES.setdefault(cls, {})[type_id] = (name, manufacturer)
+                LOGGER.warning('Trying configured device type %s: %s', type_id, name)
+                return self._open()
+            return None
+
+        return dev if connected else None
+
+    def _attach(self, dev):
+        LOGGER.info("Connected: %s", dev)
+        self._dev = self._transport.attach(dev)
+        self._mac = mac_format(dev.mac)
+        self._addresses = get_ip_addresses(dev.host[0])
+        self.restored = False
+        self.last_seen = time.time()
+        self._failures = 0
+        self._next_check = time.monotonic() + REGISTRY.health_interval
+        self._set_status('up')
+        REGISTRY._device_connected(self)
+
+    @property
+    def state(self):
+        dev = self._dev
+        if not dev:
+            return None
+        return {
+            'host': self.host,
+            'address': dev.host[0],
+            'port': dev.host[1],
+            'mac': binascii.hexlify(dev.mac).decode('US-ASCII'),
+            'devtype': dev.devtype,
+            'name': dev.name,
+            'id': dev.id,
+            'key': binascii.hexlify(dev.aes.algorithm.key).decode('US-ASCII'),
+        }
+
+    def restore(self, state):
+        # rebuilds the python-broadlink handle from what was learned in a
+        # previous run, without any network round trip
+        dev = broadlink.gendevice(state['devtype'], (state['address'], state['port']),
+                                  binascii.unhexlify(state['mac']), name=state.get('name', ''))
+        dev.id = state['id']
+        dev.update_aes(binascii.unhexlify(state['key']))
+        self._dev = self._transport.attach(dev)
+        self._mac = mac_format(dev.mac)
+        self._addresses = {dev.host[0]}
+        self.restored = True
+        self._status = 'up'
+        LOGGER.info('Restored: %s', dev)
 
     @property
     def host(self):
         return self._host
 
+    @property
+    def connected(self):
+        return self._status == 'up'
+
+    @property
+    def status(self):
+        return self._status
+
     @property
     def mac(self):
-        if self.connect():
+        if self._mac:
             return self._mac
         else:
             return '??-??-??-??-??-??'
 
     @property
     def addresses(self):
-        if self.connect():
+        if self._addresses:
             return self._addresses
         else:
             return []
 
-    def transmit(self, code, repeat=None):
-        if not isinstance(code, str):
-            code = code.decode('US-ASCII')
+    @property
+    def queue_depth(self):
+        return sum(len(queue) for queue in self._queues)
 
-        (code, repeat) = ir_decode_multiply(code, repeat)
-        command_code = REGISTRY.get_command(code)
-        if command_code:
-            code = command_code
-        return self._transmit(code, repeat=repeat)
+    @property
+    def stats(self):
+        with self._queue_cond:
+            stats = dict(self._stats)
+            stats['queue_depth'] = sum(len(queue) for queue in self._queues)
+        stats['packets'] = self._transport.packets
+        stats['retries'] = self._transport.retries
+        stats['ack_timeouts'] = self._transport.timeouts
+        stats['rtt_last'] = self._transport.rtt_last
+        return stats
 
-    def _transmit(self, code, repeat=None):
-        (code, repeat) = ir_decode(code, repeat=repeat)
-        LOGGER.debug('Transmitting to: %s (repeat: %s)', self, repeat)
-        if self.connect():
-            self._dev.send_data(code)
-            return True
-        else:
+    def transmit(self, code, repeat=None, wait=True, callback=None, priority='normal'):
+        (code, repeat) = REGISTRY.decode(code, repeat)
+        job = self.submit(code, callback, priority=priority)
+        if not wait:
+            REGISTRY.add_job(job)
+        LOGGER.debug('Queued for: %s (repeat: %s, queue depth: %s)', self, repeat, self.queue_depth)
+        return job.wait() if wait else job
+
+    def start_repeat(self, code, repeat=None):
+        (code, repeat) = REGISTRY.decode(code, repeat)
+        if not self.connected:
+            raise DeviceUnavailableError('Device is %s: %s' % (self._status, self))
+        run = RepeatRun(self, code)
+        # one continuous transmit per device, a new one replaces the old
+        with self._queue_cond:
+            (old, self._repeat) = (self._repeat, run)
+        if old:
+            old.stop()
+        run.start()
+        return run
+
+    def stop_repeat(self, code=None):
+        with self._queue_cond:
+            run = self._repeat
+            if not run or (code is not None and run.code != code):
+                return False
+            self._repeat = None
+        run.stop()
+        return True
+
+    def learn(self, type='ir', name=None, callback=None):
+        if not self.connected:
+            raise DeviceUnavailableError('Device is %s: %s' % (self._status, self))
+        if not hasattr(self._dev, 'enter_learning') or (type == 'rf' and not hasattr(self._dev, 'sweep_frequency')):
+            raise ValueError('Device cannot learn %s codes: %s' % (type.upper(), self))
+        with self._queue_cond:
+            if self._learning and not self._learning.done:
+                raise LearnError('Already learning on %s' % self)
+            session = self._learning = LearnSession(self, type, name, callback)
+        REGISTRY.add_job(session)
+        session.start()
+        return session
+
+    def _learn_call(self, method):
+        # learning commands are short exchanges that take turns with the
+        # transmits through the I/O lock
+        with self._io_lock:
+            try:
+                return getattr(self._dev, method)()
+            except (broadlink.exceptions.ReadError, broadlink.exceptions.StorageError):
+                raise
+            except (OSError, broadlink.exceptions.BroadlinkException) as e:
+                raise TransmitError('Learning on %s failed: %s' % (self, e)) from e
+
+    def submit(self, code, callback=None, coalesce=True, priority='normal'):
+        job = Job(self, code, callback, coalesce, priority)
+        shed = None
+        with self._queue_cond:
+            if self._closed:
+                raise DeviceUnavailableError('Device removed: %s' % self)
+            if not self.connected and not REGISTRY.queue_when_down:
+                self._stats['rejected'] += 1
+                raise DeviceUnavailableError('Device is %s: %s' % (self._status, self))
+            if coalesce and REGISTRY.coalesce and self._coalesce(job):
+                return job
+            if self.queue_depth >= REGISTRY.queue_size:
+                # a full queue sheds its newest code of the lowest class below
+                # the new one, and only rejects when there is none
+                lower = [queue for queue in self._queues[job.level + 1:] if queue]
+                if not lower:
+                    self._stats['rejected'] += 1
+                    raise QueueFullError('Transmit queue full for %s' % self)
+                shed = lower[-1].pop()
+                self._stats['rejected'] += 1
+            self._queues[job.level].append(job)
+            self._stats['queued'] += 1
+            if not self._worker:
+                self._worker = threading.Thread(target=self._dispatch, name='transmit-' + self.host)
+                self._worker.daemon = True
+                self._worker.start()
+            self._queue_cond.notify()
+        if shed:
+            LOGGER.warning('Transmit queue full for %s, dropped a %s code', self, shed.priority)
+            shed._finish(False, QueueFullError('Dropped from the full transmit queue of %s' % self))
+            for merged in shed.merged:
+                merged._finish(False, shed.error)
+        return job
+
+    def close(self):
+        # the device was removed: queued codes fail, the worker ends and the
+        # socket is released (a code being sent completes first)
+        with self._queue_cond:
+            self._closed = True
+            jobs = [job for queue in self._queues for job in queue]
+            for queue in self._queues:
+                queue.clear()
+            self._queue_cond.notify_all()
+        error = DeviceUnavailableError('Device removed: %s' % self)
+        for job in jobs:
+            job._finish(False, error)
+            for merged in job.merged:
+                merged._finish(False, error)
+        with self._io_lock:
+            self._transport.close()
+
+    def _coalesce(self, job):
+        # only the last queued code of the same class is considered, merging
+        # with an earlier one would reorder it with the codes queued in between
+        now = time.monotonic()
+        queue = self._queues[job.level]
+        last = queue[-1] if queue else None
+        if last is not None and not last.coalesce:
+            return False
+        if REGISTRY.coalesce == 'debounce':
+            # a duplicate shares the outcome of the code it duplicates, be it
+            # queued, being sent or already sent (unless a more urgent code
+            # would be sent in between)
+            if last is None and any(self._queues[:job.level]):
+                return False
+            last = last or self._current
+            if last is not None and last.code == job.code and now - last.created < REGISTRY.coalesce_window:
+                self._stats['debounced'] += 1
+                last.merged.append(job)
+                return True
+            if last is None and self._last_sent and self._last_sent[0] == job.code \
+                    and now - self._last_sent[1] < REGISTRY.coalesce_window:
+                self._stats['debounced'] += 1
+                job.started = now
+                job._finish(True)
+                return True
+            return False
+        if last is None or now - last.created >= REGISTRY.coalesce_window:
+            return False
+        # same code apart from the repeat count (byte 1)
+        if len(last.code) != len(job.code) or last.code[0] != job.code[0] or last.code[2:] != job.code[2:]:
             return False
+        repeat = last.code[1] + job.code[1] + 1
+        if repeat > 0xff:
+            return False
+        code = bytearray(last.code)
+        code[1] = repeat
+        last.code = bytes(code)
+        last.merged.append(job)
+        self._stats['coalesced'] += 1
+        return True
+
+    def _throttle(self, now):
+        # token bucket: rate_limit codes per second on average, with bursts of
+        # up to rate_burst codes; returns how long to wait for a token
+        rate = REGISTRY.rate_limit
+        burst = max(1, REGISTRY.rate_burst)
+        if self._tokens is None or not rate:
+            self._tokens = burst
+        else:
+            self._tokens = min(burst, self._tokens + (now - self._tokens_at) * rate)
+        self._tokens_at = now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / rate
+
+    def _dispatch(self):
+        throttled = False
+        while True:
+            with self._queue_cond:
+                # while the device is down, queued codes wait for it to be
+                # back (if queueing is enabled) instead of timing out
+                while not self._closed and (not self.queue_depth or (REGISTRY.queue_when_down and not self.connected)):
+                    self._queue_cond.wait()
+                if self._closed:
+                    self._worker = None
+                    return
+                queue = next(queue for queue in self._queues if queue)
+                # a code is held back for the coalescing window while it can
+                # still absorb repeats of itself
+                if REGISTRY.coalesce == 'repeat' and self.queue_depth == 1 and queue[0].coalesce:
+                    delay = queue[0].created + REGISTRY.coalesce_window - time.monotonic()
+                    if delay > 0:
+                        self._queue_cond.wait(delay)
+                        continue
+                # the class is picked again after waiting for a token, a more
+                # urgent code may have arrived meanwhile
+                delay = self._throttle(time.monotonic())
+                if delay > 0:
+                    throttled = True
+                    self._queue_cond.wait(delay)
+                    continue
+                job = queue.popleft()
+                self._tokens -= 1
+                if throttled:
+                    self._stats['throttled'] += 1
+                    throttled = False
+                # overtaking a code that was queued earlier in a lower class
+                if any(lower and lower[0].created < job.created for lower in self._queues[job.level + 1:]):
+                    self._stats['preempted'] += 1
+                job.started = time.monotonic()
+                self._current = job
+                wait_time = job.wait_time
+                self._stats['wait_time_last'] = wait_time
+                self._stats['wait_time_max'] = max(wait_time, self._stats['wait_time_max'])
+                self._stats['wait_time_total'] += wait_time
+            QUEUE_WAIT.observe(wait_time, self.host)
+            try:
+                result = self._send(job.code)
+                error = None
+            except Exception as e:
+                result = False
+                error = e
+            with self._queue_cond:
+                self._stats['sent' if result else 'failed'] += 1
+                self._current = None
+                if result:
+                    self._last_sent = (job.code, job.created)
+            job._finish(result, error)
+            for merged in job.merged:
+                merged.started = job.started
+                merged._finish(result, error)
+
+    def _send(self, code):
+        LOGGER.debug('Transmitting to: %s', self)
+        if not self.connected:
+            # connecting is retried in the background, not inline
+            raise DeviceUnavailableError('Device is %s: %s' % (self._status, self))
+        with self._io_lock:
+            if self._closed:
+                raise DeviceUnavailableError('Device removed: %s' % self)
+            start = time.monotonic()
+            try:
+                self._dev.send_data(code)
+            except (broadlink.exceptions.AuthenticationError,
+                    broadlink.exceptions.AuthorizationError,
+                    broadlink.exceptions.NetworkTimeoutError,
+                    OSError) as e:
+                self._set_down()
+                raise TransmitError('Transmit to %s failed: %s' % (self, e)) from e
+            except broadlink.exceptions.BroadlinkException as e:
+                # the device answered, it rejected this code only
+                raise TransmitError('Transmit to %s failed: %s' % (self, e)) from e
+            ROUND_TRIP.observe(time.monotonic() - start, self.host)
+        self.last_seen = time.time()
+        return True
 
     def __str__(self):
         return self.mac + '@' + self.host
@@ -189,4 +1457,47 @@ class Device:
     def __repr__(self):
         return self.__str__()
 
-REGISTRY = Registry()
+REGISTRY  = Registry()
+# background work that may block on device I/O
+SCHEDULER = Scheduler()
+# short, non-blocking tasks that must run on time and in order
+TIMER     = Scheduler(workers=1)
+
+def _device_stats(*keys):
+    def collect():
+        samples = []
+        for device in REGISTRY.get_devices():
+            stats = device.stats
+            samples.extend(((device.host,) + ((key,) if len(keys) > 1 else ()), stats[key]) for key in keys)
+        return samples
+    return collect
+
+METRICS        = Metrics('broadlink_bridge_')
+REQUESTS       = METRICS.counter('requests_total', 'Requests received, by front end', ('frontend',))
+DECODE_TIME    = METRICS.histogram('decode_seconds', 'Time spent decoding codes')
+LOOKUP_TIME    = METRICS.histogram('lookup_seconds', 'Time spent finding devices')
+QUEUE_WAIT     = METRICS.histogram('queue_wait_seconds', 'Time codes waited in the transmit queue', ('device',))
+ROUND_TRIP     = METRICS.histogram('round_trip_seconds', 'Time for the device to acknowledge a code', ('device',))
+DISCOVERY_TIME = METRICS.histogram('discovery_seconds', 'Duration of discovery runs', buckets=(1, 2, 5, 10, 30, 60))
+METRICS.collect('transmits_total', 'Codes handled by the transmit queue, by outcome', ('device', 'outcome'),
+                _device_stats('sent', 'failed', 'rejected'), type='counter')
+METRICS.collect('saved_total', 'Sends saved by coalescing or debouncing', ('device', 'reason'),
+                _device_stats('coalesced', 'debounced'), type='counter')
+METRICS.collect('delayed_total', 'Codes held back by the rate limit or overtaken by a more urgent one',
+                ('device', 'reason'), _device_stats('throttled', 'preempted'), type='counter')
+METRICS.collect('retries_total', 'Packets resent for lack of acknowledgement', ('device',),
+                _device_stats('retries'), type='counter')
+METRICS.collect('ack_timeouts_total', 'Packets never acknowledged', ('device',),
+                _device_stats('ack_timeouts'), type='counter')
+METRICS.collect('reconnects_total', 'Successful reconnections', ('device',),
+                _device_stats('reconnects'), type='counter')
+METRICS.collect('queue_depth', 'Codes waiting in the transmit queue', ('device',), _device_stats('queue_depth'))
+METRICS.collect('device_up', 'Whether the device is connected', ('device',),
+                lambda: [((device.host,), int(device.connected)) for device in REGISTRY.get_devices()])
+METRICS.collect('decode_cache_total', 'Decode cache lookups and evictions', ('result',),
+                lambda: [((key,), DECODE_CACHE.stats[key]) for key in ('hits', 'misses', 'evictions')],
+                type='counter')
+METRICS.collect('normalized_bytes_saved_total', 'Bytes saved by normalizing codes', (),
+                lambda: [((), NORMALIZER.saved)], type='counter')
+METRICS.collect('decode_cache_size', 'Entries in the decode cache', (),
+                lambda: [((), len(DECODE_CACHE))])
@@ -1,101 +1,330 @@
 import argparse
 import configparser
+import csv
 import logging
 import pathlib
 import signal
+import socket
 import sys
 import re
 import threading
+import time
+import xml.etree.ElementTree
 import broadlink
-from . import LOGGER, NAME, REGISTRY, SERVER
+from . import LOGGER, NAME, REGISTRY, SCHEDULER, SERVER
+from .cluster import CLUSTER
 from .http import httpd_start
+from .library import CommandLibrary, load_library
 from .lirc import lircd_start
 from .mqtt import mqtt_connect
+from .util import DECODE_CACHE, NORMALIZER, ir_decode_uncached, parse_sequence
 
 DEFAULTS = {
     'commands': {
     },
+    'sequences': {
+    },
+    'groups': {
+    },
+    'libraries': {
+    },
     'devices': {
     },
     'device_types': {
     },
     'discovery': {
         'timeout': 5,
+        'interval': '300',
+        'negative_cache_ttl': '60',
+    },
+    'transmit': {
+        'queue_size': '32',
+        'decode_cache_size': '512',
+        'job_history': '1000',
+        'coalesce': 'no',
+        'coalesce_window': '300',
+        'repeat_chunk': '200',
+        'repeat_timeout': '30',
+        'rate_limit': '0',
+        'rate_burst': '5',
+        'normalize': 'no',
+        'normalize_tolerance': '15',
+        'normalize_validate': 'yes',
+    },
+    'learning': {
+        'timeout': '30',
+        'poll_interval': '500',
+    },
+    'connection': {
+        'timeout': '5',
+        'workers': '8',
+        'ack_timeout': '1',
+        'attempts': '3',
+    },
+    'health': {
+        'interval': '60',
+        'backoff_min': '1',
+        'backoff_max': '300',
+        'queue_when_down': 'no',
+    },
+    'state': {
+        'file': '',
     },
     'http': {
         'port': '8780',
+        'backlog': '10',
+        'workers': '16',
+        'idle_timeout': '30',
+        'async': 'no',
+        'priority': 'normal',
     },
     'lirc': {
         'port': '8765',
+        'backlog': '10',
+        'workers': '16',
+        'priority': 'interactive',
+    },
+    'cluster': {
+        'enabled': 'no',
+        'node_id': '',
+        'http_url': '',
+        'forward_timeout': '10',
     },
     'mqtt': {
         'broker_url': '',
+        'topic_prefix': 'broadlink',
+        'publish_results': 'no',
+        'qos': '0',
+        'client_id': '',
+        'clean_session': 'yes',
+        'reconnect_min': '1',
+        'reconnect_max': '120',
+        'workers': '4',
+        'queue_size': '100',
+        'overflow': 'drop',
+        'priority': 'normal',
+        'keepalive': '60',
     }
 }
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='Bridge to Broadlink devices',
-    )
-    parser.add_argument('config', metavar='CONFIG-FILE', nargs='?', help='path to configuration file')
-    parser.add_argument('-d', '--debug', metavar='DEBUG', action='store_const', const=True, help='enable debug logging')
-    args = parser.parse_args()
+def read_config(path):
+    config = configparser.ConfigParser()
+    config.read_dict(DEFAULTS)
+    if path:
+        LOGGER.info('Reading config file: %s', path)
+        with open(path) as f:
+            config.read_file(f)
+    return config
 
-    console = logging.StreamHandler()
-    console.setLevel(logging.DEBUG)
-    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
-    logger = logging.getLogger('')
-    logger.addHandler(console)
-    logger.setLevel(logging.INFO if not args.debug else logging.DEBUG)
+def read_settings(config):
+    # everything is parsed and checked before anything is applied, so that an
+    # invalid setting leaves all of them unchanged
+    coalesce = config.get('transmit', 'coalesce')
+    if coalesce not in ('no', 'repeat', 'debounce'):
+        raise ValueError('Invalid [transmit] coalesce: ' + coalesce)
+    return {
+        'registry': {
+            'queue_size': config.getint('transmit', 'queue_size'),
+            'negative_cache_ttl': config.getint('discovery', 'negative_cache_ttl'),
+            'job_history': config.getint('transmit', 'job_history'),
+            'coalesce': coalesce if coalesce != 'no' else None,
+            'coalesce_window': config.getint('transmit', 'coalesce_window') / 1000,
+            'repeat_chunk': config.getint('transmit', 'repeat_chunk') / 1000,
+            'repeat_timeout': config.getint('transmit', 'repeat_timeout'),
+            'rate_limit': config.getfloat('transmit', 'rate_limit'),
+            'rate_burst': config.getint('transmit', 'rate_burst'),
+            'learn_timeout': config.getint('learning', 'timeout'),
+            'learn_interval': config.getint('learning', 'poll_interval') / 1000,
+            'connect_timeout': config.getfloat('connection', 'timeout'),
+            'connect_workers': config.getint('connection', 'workers'),
+            'ack_timeout': config.getfloat('connection', 'ack_timeout'),
+            'send_attempts': max(1, config.getint('connection', 'attempts')),
+            'health_interval': config.getint('health', 'interval'),
+            'backoff_min': config.getfloat('health', 'backoff_min'),
+            'backoff_max': config.getfloat('health', 'backoff_max'),
+            'queue_when_down': config.getboolean('health', 'queue_when_down'),
+        },
+        'decode_cache_size': config.getint('transmit', 'decode_cache_size'),
+        'normalize': (config.getboolean('transmit', 'normalize'),
+                      config.getint('transmit', 'normalize_tolerance') / 100,
+                      config.getboolean('transmit', 'normalize_validate')),
+    }
 
-    LOGGER.info('Starting %s...', SERVER)
+def apply_settings(settings):
+    for (name, value) in settings['registry'].items():
+        setattr(REGISTRY, name, value)
+    REGISTRY.configure_transports()
+    DECODE_CACHE.resize(settings['decode_cache_size'])
+    NORMALIZER.configure(*settings['normalize'])
 
-    config = configparser.SafeConfigParser()
-    config.read_dict(DEFAULTS)
-    if args.config:
-        LOGGER.info('Reading config file: %s', args.config)
-        with open(args.config) as f:
-            config.read_file(f)
+def get_sequences(config):
+    return [(name, parse_sequence(steps)) for (name, steps) in config.items('sequences')]
 
-    for item in config.items('commands'):
-        command = item[0]
-        payload = item[1]
-        REGISTRY.set_command(command, payload)
+def get_library(config):
+    libraries = config.items('libraries')
+    if not libraries:
+        return CommandLibrary()
+    start = time.monotonic()
+    entries = []
+    for (prefix, path) in libraries:
+        LOGGER.info('Reading command library: %s', path)
+        entries.extend(load_library(path, prefix))
+    library = CommandLibrary(entries)
+    LOGGER.info('Loaded %s library commands (%s bytes) in %.2f seconds',
+                len(library), library.size, time.monotonic() - start)
+    return library
+
+def get_device_types(config):
+    device_types = []
     for item in config.items('device_types'):
         type_id = item[0].lower()
         definition = item[1]
         error_prefix = "Skipping invalid [device_types] entry '%s' in config" % type_id
         if not re.match('^0x[0-9a-f]{4}$', type_id):
             LOGGER.warning("%s (expected format 0x1234)", error_prefix)
-            next
+            continue
         int_type_id = int(type_id, 16)
-        parts = re.split('\s*,\s*', definition)
+        parts = re.split(r'\s*,\s*', definition)
         if len(parts) != 3:
             LOGGER.warning("%s: %s (expected 3 parts, comma-separated)", error_prefix, definition)
-            next
+            continue
         cls, name, manufacturer = parts
         try:
             implementation_class = getattr(broadlink, cls)
         except AttributeError:
             LOGGER.warning("%s: '%s' is not a valid python-broadlink class", error_prefix, cls)
-            next
+            continue
         LOGGER.info("Registering device type %s: %s", type_id, name)
-        REGISTRY.add_device_type(int_type_id, implementation_class, name, manufacturer)
-    for item in config.items('devices'):
-        alias = item[0]
-        url = item[1]
-        REGISTRY.add_manual_device(url, alias)
+        device_types.append((int_type_id, implementation_class, name, manufacturer))
+    return device_types
+
+def reload_config(path):
+    # listeners and settings that only take effect at startup (ports, MQTT,
+    # state file, discovery interval) are left untouched
+    LOGGER.info('Reloading configuration...')
+    normalize = (NORMALIZER.enabled, NORMALIZER.tolerance, NORMALIZER.validate)
+    try:
+        config = read_config(path)
+        settings = read_settings(config)
+        sequences = get_sequences(config)
+        device_types = get_device_types(config)
+        devices = config.items('devices')
+        groups = REGISTRY.prepare_groups(config.items('groups'), devices)
+        # commands are decoded (and normalized) with the new settings
+        NORMALIZER.configure(*settings['normalize'])
+        commands = REGISTRY.prepare_commands(config.items('commands'), sequences, get_library(config))
+    except (OSError, ValueError, KeyError, csv.Error, configparser.Error, xml.etree.ElementTree.ParseError) as e:
+        NORMALIZER.configure(*normalize)
+        LOGGER.error('Reload failed, keeping the current configuration: %s', e)
+        return False
+    apply_settings(settings)
+    REGISTRY.install_commands(commands)
+    for device_type in device_types:
+        REGISTRY.add_device_type(*device_type)
+    REGISTRY.set_manual_devices(devices)
+    REGISTRY.install_groups(groups)
+    LOGGER.info('Configuration reloaded')
+    return True
+
+def normalize_report(config):
+    # what normalization would do to the configured commands, whether or not
+    # it is enabled
+    NORMALIZER.tolerance = config.getint('transmit', 'normalize_tolerance') / 100
+    (before, after) = (0, 0)
+    print('%-30s %8s %8s %8s  %s' % ('COMMAND', 'BYTES', 'NORMAL', 'SAVED', 'EQUIVALENT'))
+    for (name, data) in config.items('commands'):
+        try:
+            code = ir_decode_uncached(data)[0]
+            (normalized, equivalent) = NORMALIZER.normalize(code)
+        except ValueError as e:
+            print('%-30s %s' % (name, e))
+            continue
+        before += len(code)
+        after += len(normalized)
+        print('%-30s %8d %8d %8d  %s' % (name, len(code), len(normalized), len(code) - len(normalized),
+                                         'yes' if equivalent else 'no'))
+    print('%-30s %8d %8d %8d' % ('TOTAL', before, after, before - after))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Bridge to Broadlink devices',
+    )
+    parser.add_argument('config', metavar='CONFIG-FILE', nargs='?', help='path to configuration file')
+    parser.add_argument('-d', '--debug', metavar='DEBUG', action='store_const', const=True, help='enable debug logging')
+    parser.add_argument('--normalize-report', action='store_true', help='show the bytes that code normalization saves per command and exit')
+    args = parser.parse_args()
+
+    console = logging.StreamHandler()
+    console.setLevel(logging.DEBUG)
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
+    logger = logging.getLogger('')
+    logger.addHandler(console)
+    logger.setLevel(logging.INFO if not args.debug else logging.DEBUG)
+
+    LOGGER.info('Starting %s...', SERVER)
+
+    config = read_config(args.config)
+    if args.normalize_report:
+        normalize_report(config)
+        return
+    apply_settings(read_settings(config))
+    for device_type in get_device_types(config):
+        REGISTRY.add_device_type(*device_type)
+    REGISTRY.set_commands(config.items('commands'), get_sequences(config), get_library(config))
+    # devices known from a previous run are usable right away, they are
+    # revalidated in the background once the listeners are up
+    REGISTRY.load_state(config.get('state', 'file'))
+    REGISTRY.set_manual_devices(config.items('devices'))
+    REGISTRY.set_groups(config.items('groups'))
+
+    if config.getboolean('cluster', 'enabled'):
+        if not config.get('mqtt', 'broker_url'):
+            raise ValueError('Cluster mode requires [mqtt] broker_url')
+        http_url = config.get('cluster', 'http_url')
+        if not http_url and config.getint('http', 'port') > 0:
+            http_url = 'http://%s:%s' % (socket.getfqdn(), config.getint('http', 'port'))
+        CLUSTER.configure(config.get('cluster', 'node_id'), http_url,
+                          forward_timeout=config.getfloat('cluster', 'forward_timeout'))
 
-    REGISTRY.discover(config.getint('discovery', 'timeout'))
+    httpd_start(config.getint('http', 'port'),
+                backlog=config.getint('http', 'backlog'),
+                workers=config.getint('http', 'workers'),
+                idle_timeout=config.getint('http', 'idle_timeout'),
+                respond_async=config.getboolean('http', 'async'),
+                priority=config.get('http', 'priority'))
+    lircd_start(config.getint('lirc', 'port'),
+                backlog=config.getint('lirc', 'backlog'),
+                workers=config.getint('lirc', 'workers'),
+                priority=config.get('lirc', 'priority'))
+    mqtt_connect(config.get('mqtt', 'broker_url'),
+                 prefix=config.get('mqtt', 'topic_prefix').strip('\'"'),
+                 results=config.getboolean('mqtt', 'publish_results'),
+                 qos=config.getint('mqtt', 'qos'),
+                 client_id=config.get('mqtt', 'client_id'),
+                 clean_session=config.getboolean('mqtt', 'clean_session'),
+                 reconnect_min=config.getint('mqtt', 'reconnect_min'),
+                 reconnect_max=config.getint('mqtt', 'reconnect_max'),
+                 workers=config.getint('mqtt', 'workers'),
+                 queue_size=config.getint('mqtt', 'queue_size'),
+                 overflow=config.get('mqtt', 'overflow'),
+                 priority=config.get('mqtt', 'priority'),
+                 keepalive=config.getint('mqtt', 'keepalive'))
 
-    httpd_start(config.getint('http', 'port'))
-    lircd_start(config.getint('lirc', 'port'))
-    mqtt_connect(config.get('mqtt', 'broker_url'))
+    SCHEDULER.call_soon(REGISTRY.revalidate)
+    discovery_interval = config.getint('discovery', 'interval')
+    if discovery_interval > 0:
+        SCHEDULER.call_every(discovery_interval, REGISTRY.discover, config.getint('discovery', 'timeout'), delay=0)
+    else:
+        SCHEDULER.call_soon(REGISTRY.discover, config.getint('discovery', 'timeout'))
+    SCHEDULER.call_every(1, REGISTRY.check_health)
 
     quit = threading.Event()
     def quit_handler(signo, stack_frame):
         quit.set()
     signal.signal(signal.SIGINT, quit_handler)
     signal.signal(signal.SIGTERM, quit_handler)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signo, stack_frame: SCHEDULER.call_soon(reload_config, args.config))
     quit.wait()
     LOGGER.info('Exiting...')
+    CLUSTER.leave()
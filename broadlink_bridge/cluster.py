@@ -0,0 +1,123 @@
+import hashlib
+import json
+import socket
+import threading
+import time
+import urllib.parse
+from . import LOGGER, METRICS, Group
+
+# set on requests forwarded to the owner, which then always handles them
+FORWARDED_HEADER = 'X-Broadlink-Bridge-Forwarded'
+
+class Cluster:
+    # instances sharing a broker announce themselves with a retained message
+    # on PREFIX/cluster/nodes/ID, cleared by their last will when they die;
+    # every instance sees the same set of nodes and picks the owner of each
+    # device with rendezvous hashing, so that only the owner handles it and a
+    # dead node's devices spread over the others
+    def __init__(self):
+        self.enabled = False
+        self.node_id = None
+        self.http_url = None
+        self.forward_timeout = 10
+        self.since = None
+        self._nodes = {}
+        self._client = None
+        self._topic = None
+        self._lock = threading.Lock()
+
+    def configure(self, node_id, http_url, forward_timeout=10):
+        self.enabled = True
+        self.node_id = node_id or socket.gethostname()
+        if '/' in self.node_id or '+' in self.node_id or '#' in self.node_id:
+            raise ValueError('Invalid cluster node id: ' + self.node_id)
+        self.http_url = http_url
+        self.forward_timeout = forward_timeout
+        self.since = time.time()
+        self._nodes = {self.node_id: {'http': http_url, 'since': self.since}}
+        self.forwarded = METRICS.counter('forwarded_total', 'HTTP requests forwarded to the owner, by node', ('node',))
+        METRICS.collect('cluster_nodes', 'Live cluster nodes', (), lambda: [((), len(self._nodes))])
+        LOGGER.info('Cluster node %s (HTTP: %s)', self.node_id, http_url or 'none')
+
+    def mqtt_setup(self, client, prefix):
+        # the will must be set before connecting
+        self._client = client
+        self._topic = prefix + 'cluster/nodes/' + self.node_id
+        client.will_set(self._topic, b'', qos=1, retain=True)
+        client.message_callback_add(prefix + 'cluster/nodes/+', self.mqtt_on_presence)
+
+    def mqtt_on_connect(self, client):
+        client.subscribe(self._topic.rsplit('/', 1)[0] + '/+', 1)
+        self._announce()
+
+    def _announce(self):
+        payload = json.dumps({'http': self.http_url, 'since': self.since})
+        self._client.publish(self._topic, payload, qos=1, retain=True)
+
+    def mqtt_on_presence(self, client, userdata, msg):
+        node_id = msg.topic.rsplit('/', 1)[1]
+        if node_id == self.node_id:
+            if not msg.payload:
+                # the will of a previous run with the same id
+                self._announce()
+            return
+        node = None
+        if msg.payload:
+            try:
+                node = json.loads(msg.payload)
+            except ValueError:
+                LOGGER.warning('Cluster: invalid presence of node %s', node_id)
+                return
+        with self._lock:
+            known = node_id in self._nodes
+            if node is not None:
+                self._nodes[node_id] = node
+            else:
+                self._nodes.pop(node_id, None)
+        if node is not None and not known:
+            LOGGER.info('Cluster: node %s joined (%s nodes)', node_id, len(self._nodes))
+        elif node is None and known:
+            LOGGER.info('Cluster: node %s left (%s nodes)', node_id, len(self._nodes))
+
+    def leave(self):
+        # faster than waiting for the broker to notice and send the will
+        if self._client:
+            info = self._client.publish(self._topic, b'', qos=1, retain=True)
+            try:
+                info.wait_for_publish(1)
+            except (RuntimeError, ValueError):
+                pass
+
+    def nodes(self):
+        with self._lock:
+            return dict(self._nodes)
+
+    def key(self, device):
+        if isinstance(device, str):
+            return device
+        if isinstance(device, Group):
+            return 'group/' + device.name
+        return device.host
+
+    def owner(self, device):
+        if not self.enabled:
+            return None
+        key = self.key(device)
+        # rendezvous hashing: only the devices of a node that leaves move,
+        # and they spread evenly over the remaining nodes
+        return max(self.nodes(), key=lambda node_id: hashlib.sha1((node_id + '\0' + key).encode('UTF-8')).digest())
+
+    def owns(self, device):
+        return not self.enabled or self.owner(device) == self.node_id
+
+    def peer_address(self, node_id):
+        node = self.nodes().get(node_id)
+        if not node or not node.get('http'):
+            return None
+        url = urllib.parse.urlparse(node['http'])
+        return (url.hostname, url.port or 80)
+
+    def peers(self):
+        return [node_id for node_id in sorted(self.nodes()) if node_id != self.node_id]
+
+CLUSTER = Cluster()
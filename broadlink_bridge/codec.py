@@ -0,0 +1,235 @@
+import array
+import collections
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Broadlink pulse lengths are expressed in units of 8192/269 µs (~30.45 µs)
+UNIT_NUMERATOR   = 269
+UNIT_DENOMINATOR = 8192
+# Pronto frequency words are expressed in units of 0.241246 µs
+PRONTO_CLOCK     = 0.241246
+PRONTO_DEFAULT_FREQUENCY = 0x006D # ~38 kHz
+
+TYPE_IR        = 0x26
+TYPE_RF_433MHZ = 0xb2
+TYPE_RF_315MHZ = 0xd7
+TYPES          = (TYPE_IR, TYPE_RF_433MHZ, TYPE_RF_315MHZ)
+TERMINATOR     = b'\x0d\x05'
+GAP_UNITS      = 0x0d05
+# spaces of 10 ms and more separate frames, no protocol has them within one
+FRAME_GAP_UNITS = 328
+# pulse widths within this ratio of each other are considered the same, as IR
+# receivers typically accept 25% off the nominal width
+EQUIVALENCE_TOLERANCE = 0.25
+
+# below this number of pulses the NumPy path costs more than it saves
+NUMPY_THRESHOLD = 256
+
+def pronto_words(pronto):
+    if len(pronto) % 4:
+        raise ValueError('Pronto code length should be a multiple of 4')
+    words = array.array('H', bytes.fromhex(pronto))
+    if sys.byteorder == 'little':
+        words.byteswap()
+    return words
+
+def pronto_to_units(pronto):
+    words = pronto_words(pronto)
+    if len(words) < 4:
+        raise ValueError('Code is too short')
+    if words[0]:
+        raise ValueError('Pronto code should start with 0000')
+    if len(words) != 4 + 2 * (words[2] + words[3]):
+        raise ValueError('Number of pulse widths does not match preamble')
+    if words[1] == 0:
+        raise ValueError('Invalid frequency')
+    # same floating point operations as the original pronto2broadlink
+    # conversion, so that the generated packets are identical
+    frequency = 1 / (words[1] * PRONTO_CLOCK)
+    if numpy is not None and len(words) - 4 >= NUMPY_THRESHOLD:
+        pulses = numpy.frombuffer(words, dtype=numpy.uint16, offset=8)
+        pulses = numpy.rint(pulses / frequency).astype(numpy.int64)
+        return pulses * UNIT_NUMERATOR // UNIT_DENOMINATOR
+    return [int(round(word / frequency)) * UNIT_NUMERATOR // UNIT_DENOMINATOR for word in words[4:]]
+
+def pronto_to_broadlink(pronto):
+    return units_to_broadlink(pronto_to_units(pronto))
+
+def units_to_broadlink(units, repeat=0, type=TYPE_IR):
+    if numpy is not None and isinstance(units, numpy.ndarray):
+        return _units_to_broadlink_numpy(units, repeat, type)
+
+    long = sum(1 for unit in units if unit > 0xff)
+    size = len(units) + 2 * long
+    packet = _allocate(size, repeat, type)
+    if not long:
+        packet[4:4 + size] = bytes(units)
+    else:
+        i = 4
+        for unit in units:
+            if unit < 0x100:
+                packet[i] = unit
+                i += 1
+            elif unit <= 0xffff:
+                # 0x00 escapes a 2-byte (BE) value
+                packet[i + 1] = unit >> 8
+                packet[i + 2] = unit & 0xff
+                i += 3
+            else:
+                raise ValueError('Pulse too long')
+    return packet
+
+def _units_to_broadlink_numpy(units, repeat, type):
+    if len(units) and (units.min() < 0 or units.max() > 0xffff):
+        raise ValueError('Pulse too long' if units.max() > 0xffff else 'Negative pulse')
+    long = units > 0xff
+    size = len(units) + 2 * int(numpy.count_nonzero(long))
+    packet = _allocate(size, repeat, type)
+    data = numpy.frombuffer(packet, dtype=numpy.uint8, count=size, offset=4)
+    # each long pulse shifts the following ones by 2 bytes (the 0x00 escape
+    # stays zero from the allocation)
+    position = numpy.arange(len(units)) + 2 * (numpy.cumsum(long) - long)
+    short = ~long
+    data[position[short]] = units[short]
+    data[position[long] + 1] = units[long] >> 8
+    data[position[long] + 2] = units[long] & 0xff
+    return packet
+
+def _allocate(size, repeat, type):
+    length = 4 + size + len(TERMINATOR)
+    # pad to make the packet, including the 4-byte header that is prefixed
+    # when sending, a multiple of 16 for 128-bit AES encryption
+    length += -(length + 4) % 16
+    packet = bytearray(length)
+    packet[0] = type
+    packet[1] = repeat
+    packet[2] = size & 0xff
+    packet[3] = size >> 8
+    packet[4 + size:4 + size + len(TERMINATOR)] = TERMINATOR
+    return packet
+
+def broadlink_to_units(packet):
+    if len(packet) < 4 or packet[0] not in TYPES:
+        raise ValueError('Not a valid Broadlink code')
+    size = packet[2] | packet[3] << 8
+    data = bytes(packet[4:4 + size])
+    if len(data) != size:
+        raise ValueError('Broadlink code is truncated')
+
+    units = []
+    i = 0
+    while i < size:
+        # copy runs of 1-byte pulses in bulk, stopping at each 0x00 escape
+        j = data.find(0, i)
+        if j < 0:
+            units.extend(data[i:])
+            break
+        units.extend(data[i:j])
+        if j + 2 >= size:
+            raise ValueError('Broadlink code is truncated')
+        units.append(data[j + 1] << 8 | data[j + 2])
+        i = j + 3
+    return units
+
+def unit_to_microseconds(unit):
+    # the forward conversion truncates, so the middle of the unit is the
+    # best estimate of the original duration
+    return (unit + 0.5) * UNIT_DENOMINATOR / UNIT_NUMERATOR
+
+def broadlink_duration(packet):
+    # microseconds taken by one frame, not counting the repeats in byte 1
+    return sum(broadlink_to_units(packet)) * UNIT_DENOMINATOR / UNIT_NUMERATOR
+
+def broadlink_to_microseconds(packet):
+    return [int(round(unit_to_microseconds(unit))) for unit in broadlink_to_units(packet)]
+
+def microseconds_to_broadlink(timings, repeat=0, type=TYPE_IR):
+    return units_to_broadlink([int(round(us)) * UNIT_NUMERATOR // UNIT_DENOMINATOR for us in timings], repeat, type)
+
+def broadlink_to_pronto(packet, frequency=PRONTO_DEFAULT_FREQUENCY):
+    if packet[0] != TYPE_IR:
+        raise ValueError('Only IR codes can be converted to Pronto')
+    units = broadlink_to_units(packet)
+    if len(units) % 2:
+        # Pronto needs mark/space pairs, close the last mark with a gap
+        units.append(GAP_UNITS)
+    scale = UNIT_DENOMINATOR / UNIT_NUMERATOR / (frequency * PRONTO_CLOCK)
+    words = [0x0000, frequency, len(units) // 2, 0x0000]
+    words.extend(min(0xffff, max(1, round((unit + 0.5) * scale))) for unit in units)
+    return ('%04X ' * len(words) % tuple(words))[:-1]
+
+def quantize(units, tolerance):
+    # marks and spaces are clustered separately: sorted widths each within
+    # tolerance of the previous one form a cluster and are replaced by its
+    # average, which removes the jitter of learned codes
+    units = list(units)
+    for start in (0, 1):
+        counts = collections.Counter(units[start::2])
+        mapping = {}
+        cluster = []
+        for width in sorted(counts) + [None]:
+            if cluster and (width is None or width > cluster[-1] * (1 + tolerance) + 1):
+                total = sum(counts[member] for member in cluster)
+                average = int(round(sum(member * counts[member] for member in cluster) / total))
+                mapping.update((member, average) for member in cluster)
+                cluster = []
+            cluster.append(width)
+        units[start::2] = [mapping[unit] for unit in units[start::2]]
+    return units
+
+def split_frames(units):
+    # each frame ends with the long space that follows it, except possibly
+    # the last one
+    frames = []
+    begin = 0
+    for i in range(1, len(units), 2):
+        if units[i] >= FRAME_GAP_UNITS:
+            frames.append(units[begin:i + 1])
+            begin = i + 1
+    if begin < len(units):
+        frames.append(units[begin:])
+    return frames
+
+def normalize(packet, tolerance=0.15):
+    units = [int(unit) for unit in broadlink_to_units(packet)]
+    if not units:
+        return packet
+    repeat = packet[1]
+    units = quantize(units, tolerance)
+    frames = split_frames(units)
+    first = frames[0]
+    if len(frames) > 1 and len(frames) * (repeat + 1) <= 0x100 and \
+            all(len(frame) in (len(first), len(first) - 1) and frame[:len(first) - 1] == first[:-1] for frame in frames[1:]):
+        # the same frame several times: sent once, with a higher repeat count
+        units = first
+        repeat = len(frames) * (repeat + 1) - 1
+    if len(units) % 2 == 0 and units[-1] > GAP_UNITS:
+        # only the silence before a repeat matters, and not beyond the usual gap
+        units[-1] = GAP_UNITS
+    return units_to_broadlink(units, repeat, packet[0])
+
+def _expand(packet):
+    units = list(broadlink_to_units(packet)) * (packet[1] + 1)
+    if len(units) % 2 == 0:
+        # the final silence is not part of the signal
+        units.pop()
+    return units
+
+def equivalent(packet, other, tolerance=EQUIVALENCE_TOLERANCE):
+    # whether both send the same signal: the same sequence of pulses over all
+    # repeats, each within tolerance, where any two frame gaps are alike
+    if packet[0] != other[0]:
+        return False
+    (units, other_units) = (_expand(packet), _expand(other))
+    if len(units) != len(other_units):
+        return False
+    for (i, (unit, other_unit)) in enumerate(zip(units, other_units)):
+        if i % 2 and unit >= FRAME_GAP_UNITS and other_unit >= FRAME_GAP_UNITS:
+            continue
+        if abs(unit - other_unit) > max(2, tolerance * max(unit, other_unit)):
+            return False
+    return True
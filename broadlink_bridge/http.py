@@ -1,9 +1,36 @@
+import http.client
 import http.server
+import json
 import threading
-from . import LOGGER, REGISTRY, SERVER
+from . import LOGGER, METRICS, REGISTRY, REQUESTS, SERVER, DeviceNotFoundError, Group, LearnError, TransmitError, check_priority
+from .cluster import CLUSTER, FORWARDED_HEADER
+from .util import BoundedThreadingMixIn, parse_learn
+
+PRIORITY_HEADER = 'X-Broadlink-Priority'
 
 class Handler(http.server.BaseHTTPRequestHandler):
     server_version = SERVER
+    protocol_version = 'HTTP/1.1'
+    respond_async = False
+    priority = 'normal'
+    payload_read = False
+
+    def handle(self):
+        # between requests a connection only waits and does not hold its
+        # worker: when all are taken, the one idle the longest is closed
+        self.close_connection = True
+        while True:
+            self.server.set_idle(self.request, True)
+            try:
+                waiting = self.rfile.peek(1)
+            except OSError:
+                waiting = b''
+            if not self.server.set_idle(self.request, False) or not waiting:
+                break
+            self.payload_read = False
+            self.handle_one_request()
+            if self.close_connection:
+                break
 
     def log_request(self, code='-', size='-'):
         LOGGER.debug('HTTP: %s code %s', self.requestline, code)
@@ -13,48 +40,276 @@ class Handler(http.server.BaseHTTPRequestHandler):
 
     def send_error(self, code, message=None, explain=None):
         self.log_error("code %d, message %s", code, message)
+        if not self.payload_read:
+            # an unread body would be taken for the next request
+            headers = getattr(self, 'headers', None)
+            if headers is None or headers.get('Content-Length', '0').strip() != '0' or 'Transfer-Encoding' in headers:
+                self.close_connection = True
         self.send_response(code, message)
+        self.send_header('Content-Length', '0')
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def send_json(self, data, code=200):
+        body = json.dumps(data).encode('UTF-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
+        self.wfile.write(body)
+
+    def send_accepted(self, job):
+        body = json.dumps({'id': job.id}).encode('UTF-8')
+        self.send_response(202, 'Accepted')
+        self.send_header('Location', '/job/' + job.id)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def wants_async(self):
+        prefer = self.headers.get('Prefer', '')
+        if 'respond-async' in prefer:
+            return True
+        if 'respond-sync' in prefer:
+            return False
+        return self.respond_async
+
+    def fetch(self, node_id, payload=None):
+        # the same request, made to another cluster node
+        address = CLUSTER.peer_address(node_id)
+        if not address:
+            return None
+        headers = {name: self.headers[name] for name in ('Content-Type', PRIORITY_HEADER, 'Prefer') if name in self.headers}
+        headers[FORWARDED_HEADER] = CLUSTER.node_id
+        conn = http.client.HTTPConnection(*address, timeout=CLUSTER.forward_timeout)
+        try:
+            conn.request(self.command, self.path, body=payload, headers=headers)
+            response = conn.getresponse()
+            return (response.status, response.reason, response.getheaders(), response.read())
+        except OSError as e:
+            LOGGER.warning('HTTP: forwarding to cluster node %s failed: %s', node_id, e)
+            return None
+        finally:
+            conn.close()
+
+    def relay(self, node_id, response):
+        (status, reason, headers, body) = response
+        CLUSTER.forwarded.inc(node_id)
+        self.send_response(status, reason)
+        for (name, value) in headers:
+            if name.lower() in ('content-type', 'location'):
+                self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def forward(self, device, payload):
+        # requests for a device owned by another node are handled there, or
+        # here when the owner cannot be reached
+        if not CLUSTER.enabled or self.headers.get(FORWARDED_HEADER):
+            return False
+        owner = CLUSTER.owner(device)
+        if owner == CLUSTER.node_id:
+            return False
+        response = self.fetch(owner, payload)
+        if response is None:
+            return False
+        self.relay(owner, response)
+        return True
+
+    def get_priority(self):
+        # not the standard Priority header (RFC 9218), which browsers send
+        # with a different meaning
+        return check_priority(self.headers.get(PRIORITY_HEADER, self.priority).strip().lower())
+
+    def read_payload(self):
+        size = int(self.headers.get('Content-Length', 0))
+        payload = self.rfile.read(size) if size > 0 else b''
+        self.payload_read = True
+        return payload
+
+    def send_metrics(self):
+        body = METRICS.render().encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path
+        if path == '/metrics':
+            return self.send_metrics()
+        REQUESTS.inc('http')
+        if path.startswith('/job/'):
+            job = REGISTRY.get_job(path[5:])
+            if not job and CLUSTER.enabled and not self.headers.get(FORWARDED_HEADER):
+                # jobs live on the node that ran them
+                for node_id in CLUSTER.peers():
+                    response = self.fetch(node_id)
+                    if response and response[0] != 404:
+                        return self.relay(node_id, response)
+            if not job:
+                return self.send_error(404, 'Job not found: ' + path[5:])
+            return self.send_json(job.to_dict())
+        if not path.startswith('/device/'):
+            return self.send_error(404)
+        device_id = path[8:]
+        if not device_id or '/' in device_id:
+            return self.send_error(404)
+
+        device = REGISTRY.find_device(device_id)
+        if not device:
+            return self.send_error(404, 'Device not found: ' + device_id)
+        if isinstance(device, Group):
+            return self.send_json({
+                'group': device.name,
+                'status': device.status,
+                'members': [{
+                    'member': member,
+                    'host': member_device.host if member_device else None,
+                    'status': member_device.status if member_device else 'unknown',
+                } for (member, member_device) in device.resolve()],
+            })
+
+        status = {
+            'host': device.host,
+            'mac': device.mac,
+            'status': device.status,
+            'status_since': device.status_since,
+            'last_seen': device.last_seen,
+            'stats': device.stats,
+        }
+        if CLUSTER.enabled:
+            status['owner'] = CLUSTER.owner(device)
+        self.send_json(status)
 
     def do_POST(self):
+        # the body must always be consumed to keep the connection usable
+        payload = self.read_payload()
+        REQUESTS.inc('http')
+
+        try:
+            priority = self.get_priority()
+        except ValueError as e:
+            return self.send_error(400, str(e))
+
         path = self.path
+        if path == '/sequence':
+            return self.do_POST_sequence(payload, priority)
         if not path.startswith('/device/'):
             return self.send_error(404)
         path = path[8:]
 
         path = path.split('/', 1)
-        if len(path) != 1:
+        if len(path) != 1 and path[1] not in ('start', 'stop', 'learn'):
             return self.send_error(404)
 
         device_id = path[0]
         device = REGISTRY.find_device(device_id)
         if not device:
             return self.send_error(404, 'Device not found: ' + device_id)
+        if self.forward(device, payload):
+            return
+        if len(path) != 1 and path[1] == 'learn':
+            return self.do_POST_learn(device, payload)
+        if len(path) != 1:
+            return self.do_POST_repeat(device, path[1], payload)
 
-        size = int(self.headers.get('Content-Length', 0))
-        payload = self.rfile.read(size)
         if not payload:
             return self.send_error(400, 'No payload')
+        if isinstance(device, Group):
+            return self.do_POST_group(device, payload, priority)
         try:
-            if device.transmit(payload):
+            if self.wants_async():
+                return self.send_accepted(device.transmit(payload, wait=False, priority=priority))
+            if device.transmit(payload, priority=priority):
                 self.send_response(204, 'OK')
                 self.end_headers()
                 return
         except ValueError:
             pass
+        except TransmitError as e:
+            return self.send_error(503, str(e))
         self.send_error(400, 'Bad payload')
 
-def httpd_start(port):
+    def do_POST_repeat(self, device, action, payload):
+        try:
+            if action == 'start':
+                if not payload:
+                    return self.send_error(400, 'No payload')
+                device.start_repeat(payload)
+            else:
+                # without a payload, whatever is being sent is stopped
+                code = REGISTRY.decode(payload)[0] if payload else None
+                if not device.stop_repeat(code):
+                    return self.send_error(404, 'Not transmitting')
+        except ValueError:
+            return self.send_error(400, 'Bad payload')
+        except TransmitError as e:
+            return self.send_error(503, str(e))
+        self.send_response(204, 'OK')
+        self.end_headers()
+
+    def do_POST_learn(self, device, payload):
+        if isinstance(device, Group):
+            return self.send_error(400, 'Groups cannot learn')
+        try:
+            (type, name) = parse_learn(payload)
+            session = device.learn(type, name)
+        except ValueError as e:
+            return self.send_error(400, str(e))
+        except LearnError as e:
+            return self.send_error(409, str(e))
+        except TransmitError as e:
+            return self.send_error(503, str(e))
+        # the code is captured in the background, see GET /job/<id>
+        self.send_accepted(session)
+
+    def do_POST_group(self, group, payload, priority):
+        try:
+            if self.wants_async():
+                return self.send_accepted(group.transmit(payload, wait=False, priority=priority))
+            job = group.transmit(payload, priority=priority)
+        except ValueError:
+            return self.send_error(400, 'Bad payload')
+        # 207 when only some of the members failed
+        self.send_json(job.to_dict(), {'succeeded': 200, 'partial': 207}.get(job.status, 503))
+
+    def do_POST_sequence(self, payload, priority):
+        if not payload:
+            return self.send_error(400, 'No payload')
+        try:
+            run = REGISTRY.run_sequence(REGISTRY.parse_sequence(payload), priority=priority)
+        except DeviceNotFoundError as e:
+            return self.send_error(404, str(e))
+        except ValueError as e:
+            return self.send_error(400, str(e))
+        # the steps are sent in the background
+        self.send_accepted(run)
+
+class Server(BoundedThreadingMixIn, http.server.HTTPServer):
+    label = 'HTTP'
+
+def httpd_start(port, backlog=10, workers=16, idle_timeout=30, respond_async=False, priority='normal'):
     if not port or port <= 0:
         LOGGER.info('HTTP server disabled')
         return False
 
-    httpd = http.server.HTTPServer(('', port), Handler)
-    httpd.request_queue_size = 10
-    
+    Handler.timeout = idle_timeout if idle_timeout and idle_timeout > 0 else None
+    Handler.respond_async = respond_async
+    Handler.priority = check_priority(priority)
+    httpd = Server(('', port), Handler, bind_and_activate=False)
+    httpd.request_queue_size = backlog
+    httpd.max_threads = workers
+    httpd.server_bind()
+    httpd.server_activate()
+
     httpd_thread = threading.Thread(target=httpd.serve_forever)
     httpd_thread.daemon = True
     httpd_thread.start()
-    
-    LOGGER.info('HTTP server started on port %s', port)
-    return True
\ No newline at end of file
+
+    LOGGER.info('HTTP server started on port %s (workers: %s, backlog: %s)', port, workers, backlog)
+    return True
@@ -0,0 +1,142 @@
+import array
+import base64
+import binascii
+import bisect
+import csv
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+
+class CommandLibrary:
+    # read-only set of named codes, meant for large IR databases: the codes
+    # are kept in binary form (see pack) in a single buffer, indexed by the
+    # sorted names, and only decoded when used
+    def __init__(self, entries=()):
+        codes = {}
+        for (name, code) in entries:
+            codes[name] = code
+        self._names = sorted(codes)
+        self._offsets = array.array('L', [0])
+        parts = []
+        offset = 0
+        for name in self._names:
+            code = pack(codes[name])
+            parts.append(code)
+            offset += len(code)
+            self._offsets.append(offset)
+        self._buffer = b''.join(parts)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return self._find(name) >= 0
+
+    def _find(self, name):
+        i = bisect.bisect_left(self._names, name)
+        if i < len(self._names) and self._names[i] == name:
+            return i
+        return -1
+
+    def get(self, name):
+        i = self._find(name)
+        if i < 0:
+            return None
+        return unpack(self._buffer[self._offsets[i]:self._offsets[i + 1]])
+
+    def names(self, prefix=''):
+        start = bisect.bisect_left(self._names, prefix)
+        # every name with the prefix sorts before prefix + U+10FFFF
+        end = bisect.bisect_left(self._names, prefix + '\U0010ffff', start)
+        return self._names[start:end]
+
+    @property
+    def size(self):
+        return len(self._buffer)
+
+def pack(code):
+    # Pronto hex and base64 take half and 3/4 of their text size as bytes,
+    # anything else (e.g. with a repeat prefix) is kept as text
+    if len(code) % 4 == 0 and code.startswith('0000'):
+        try:
+            return b'P' + bytes.fromhex(code)
+        except ValueError:
+            pass
+    if len(code) % 4 == 0:
+        try:
+            data = base64.b64decode(code, validate=True)
+            if base64.b64encode(data).decode('US-ASCII') == code:
+                return b'B' + data
+        except binascii.Error:
+            pass
+    return b'T' + code.encode('US-ASCII')
+
+def unpack(data):
+    if data[0:1] == b'P':
+        return data[1:].hex().upper()
+    if data[0:1] == b'B':
+        return base64.b64encode(data[1:]).decode('US-ASCII')
+    return data[1:].decode('US-ASCII')
+
+def load_library(path, prefix=''):
+    # the format is chosen by the file extension
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        entries = read_csv(path)
+    elif extension == '.json':
+        entries = read_json(path)
+    elif extension in ('.girr', '.xml'):
+        entries = read_girr(path)
+    else:
+        raise ValueError('Unsupported library format: ' + path)
+    if prefix:
+        prefix = prefix.rstrip('/') + '/'
+    for (name, code) in entries:
+        name = name.strip().replace(' ', '_')
+        code = code.replace(' ', '').strip()
+        if name and code:
+            yield (prefix + name, code)
+
+def read_csv(path):
+    # NAME,CODE per line, optionally with a header row
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or row[0].startswith('#') or row[0].strip().lower() == 'name':
+                continue
+            yield (row[0], row[1])
+
+def read_json(path):
+    # either a list of {"name": ..., "code": ...} or (nested) objects of
+    # name: code, nesting levels becoming parts of the name
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        for item in data:
+            yield (item['name'], item['code'])
+    else:
+        yield from _flatten(data, '')
+
+def _flatten(data, prefix):
+    for (name, value) in data.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, prefix + name + '/')
+        else:
+            yield (prefix + name, value)
+
+def read_girr(path):
+    # IrScrutinizer Girr export: commands with a Pronto (ccf) representation
+    # are named REMOTE/COMMAND, others are skipped
+    remote = None
+    for (event, element) in ElementTree.iterparse(path, events=('start', 'end')):
+        tag = element.tag.rsplit('}', 1)[-1]
+        if event == 'start':
+            if tag == 'remote':
+                remote = element.get('name')
+            continue
+        if tag == 'command':
+            for child in element:
+                if child.tag.rsplit('}', 1)[-1] == 'ccf' and child.text:
+                    name = element.get('name')
+                    yield ((remote + '/' + name) if remote else name, child.text)
+                    break
+            element.clear()
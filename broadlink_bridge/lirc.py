@@ -1,45 +1,76 @@
 import socketserver
 import threading
-from . import LOGGER, REGISTRY, SERVER
+from . import LOGGER, PRIORITIES, REGISTRY, REQUESTS, SERVER, Group, GroupJob, TransmitError, check_priority
+from .util import BoundedThreadingMixIn
+
+class Handler(socketserver.BaseRequestHandler):
+    bufsize = 65536
+    priority = 'interactive'
 
-class Handler(socketserver.StreamRequestHandler):
     def handle(self):
+        self.out = []
+        self.repeating = {}
+        try:
+            self.serve()
+        finally:
+            # continuous transmits end with the connection that started them
+            for (device, code) in self.repeating.items():
+                device.stop_repeat(code)
+
+    def serve(self):
+        pending = b''
         while(True):
-            self.line = self.readline()
-            self.line = self.line.decode('UTF-8')
-            if not self.line:
+            data = self.request.recv(self.bufsize)
+            if not data:
+                if pending:
+                    self.handle_line(pending)
+                    self.flush()
                 break
-            parsed = self.line.split(' ', 1)
-            command = parsed[0]
-            args = None
-            if len(parsed) > 1:
-                args = parsed[1]
-            self.handle_command(command, args)
+            # all complete lines received so far are handled in one go and
+            # their replies written with a single send
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            try:
+                for line in lines:
+                    self.handle_line(line)
+            finally:
+                self.flush()
 
-    def readline(self):
-       line = self.rfile.readline()
-       line = line.strip()
-       return line
+    def handle_line(self, line):
+        # a malformed line only fails itself, not the replies to the other
+        # lines of the same batch
+        self.line = line.strip().decode('UTF-8', 'replace')
+        if not self.line:
+            return
+        REQUESTS.inc('lirc')
+        parsed = self.line.split(' ', 1)
+        command = parsed[0]
+        args = None
+        if len(parsed) > 1:
+            args = parsed[1]
+        try:
+            self.handle_command(command, args)
+        except Exception as e:
+            LOGGER.warning('LIRC: invalid command %s: %s', self.line, e)
+            self.reply(False)
 
     def reply(self, success=True, data=None):
-        self.writeline('BEGIN')
-        self.writeline(self.line)
-        self.writeline('SUCCESS' if success else 'ERROR')
+        out = self.out
+        out.append('BEGIN')
+        out.append(self.line)
+        out.append('SUCCESS' if success else 'ERROR')
         if data:
-            self.writeline('DATA')
-            self.writeline(str(len(data)))
-            for line in data:
-                self.writeline(line)
-        self.writeline('END')
-   
-    def write(self, data):
-        if isinstance(data, str):
-            data = data.encode('UTF-8')
-        self.wfile.write(data)
-        return self
-    
-    def writeline(self, line):
-        self.write(line).write(b'\n').wfile.flush()
+            data = list(data)
+            out.append('DATA')
+            out.append(str(len(data)))
+            out.extend(data)
+        out.append('END')
+
+    def flush(self):
+        if self.out:
+            self.out.append('')
+            self.request.sendall('\n'.join(self.out).encode('UTF-8'))
+            self.out = []
 
     def handle_command(self, command, args):
         if command == 'VERSION':
@@ -49,11 +80,15 @@ class Handler(socketserver.StreamRequestHandler):
             if not args:
                 self.reply(True, [str(dev.host) for dev in REGISTRY.get_devices()])
             else:
-                self.reply(True, REGISTRY.get_commands())
+                # LIST DEVICE [PREFIX]
+                args = args.split(' ')
+                self.reply(True, REGISTRY.get_commands(args[1] if len(args) > 1 else ''))
             return
         elif command == 'SEND_ONCE':
             if args:
                 payload   = args.split(' ')
+                # optional trailing priority: SEND_ONCE DEVICE CODE [REPEAT] [PRIORITY]
+                priority  = payload.pop() if len(payload) > 2 and payload[-1] in PRIORITIES else self.priority
                 device_id = payload[0]
                 command   = payload[1]
                 repeat    = int(payload[2]) if len(payload) > 2 else None
@@ -61,9 +96,41 @@ class Handler(socketserver.StreamRequestHandler):
                 device  = REGISTRY.find_device(device_id)
                 if device and command:
                     try:
-                        device.transmit(command, repeat)
+                        result = device.transmit(command, repeat, priority=priority)
+                        if isinstance(result, GroupJob):
+                            # one line per member: MEMBER STATUS LATENCY_MS
+                            self.reply(result.result, ['%s %s %s' % (
+                                member['member'], member['status'],
+                                '%.1f' % (member['latency'] * 1000) if member['latency'] is not None else '-')
+                                for member in result.to_dict()['members']])
+                            return
+                        self.reply()
+                        return
+                    except (ValueError, TransmitError):
+                        pass
+        elif command == 'SEND_START':
+            if args:
+                payload = args.split(' ')
+                device = REGISTRY.find_device(payload[0])
+                if device and len(payload) > 1:
+                    try:
+                        runs = device.start_repeat(payload[1])
+                        for run in (runs if isinstance(device, Group) else [runs]):
+                            self.repeating[run.device] = run.code
                         self.reply()
                         return
+                    except (ValueError, TransmitError):
+                        pass
+        elif command == 'SEND_STOP':
+            if args:
+                payload = args.split(' ')
+                device = REGISTRY.find_device(payload[0])
+                if device and len(payload) > 1:
+                    try:
+                        (code, repeat) = REGISTRY.decode(payload[1])
+                        if device.stop_repeat(code):
+                            self.reply()
+                            return
                     except ValueError:
                         pass
         elif command == 'SEND_CCF_ONCE':
@@ -77,21 +144,29 @@ class Handler(socketserver.StreamRequestHandler):
                         device.transmit(payload, repeat=repeat)
                         self.reply()
                         return
-                except ValueError:
+                except (ValueError, TransmitError):
                     pass
         self.reply(False)
 
-class Server(socketserver.TCPServer):
+class Server(BoundedThreadingMixIn, socketserver.TCPServer):
+    # clients stay connected indefinitely, so one over the limit is refused
+    # instead of waiting for a slot that may never free up
+    label = 'LIRC'
+    reject_when_full = True
+
     def handle_error(self, request, client_address):
         super().handle_error(request, client_address)
 
-def lircd_start(port):
+def lircd_start(port, backlog=10, workers=16, priority='interactive'):
     if not port or port <= 0:
         LOGGER.info('LIRC server disabled')
         return False
     
+    Handler.priority = check_priority(priority)
     lircd = Server(('', port), Handler, bind_and_activate=False)
     lircd.allow_reuse_address = True
+    lircd.request_queue_size = backlog
+    lircd.max_threads = workers
     lircd.server_bind()
     lircd.server_activate()
     
@@ -99,5 +174,5 @@ def lircd_start(port):
     lircd_thread.daemon = True
     lircd_thread.start()
 
-    LOGGER.info('LIRC server started on port %s', port)
-    return True
\ No newline at end of file
+    LOGGER.info('LIRC server started on port %s (workers: %s, backlog: %s)', port, workers, backlog)
+    return True
@@ -0,0 +1,115 @@
+import bisect
+import threading
+
+# seconds, from a cached decode up to a device that is timing out
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape(value)) for (name, value) in zip(names, values)]
+    if extra:
+        pairs.append('%s="%s"' % extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for (labels, value) in values:
+            yield (self.name, _labels(self.labels, labels), value)
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        # counts are kept per bucket and only accumulated when rendered
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                data = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            data[0][bisect.bisect_left(self.buckets, value)] += 1
+            data[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for (labels, (counts, total)) in self._values.items())
+        for (labels, (counts, total)) in values:
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield (self.name + '_bucket', _labels(self.labels, labels, ('le', _number(bound))), cumulative)
+            yield (self.name + '_sum', _labels(self.labels, labels), total)
+            yield (self.name + '_count', _labels(self.labels, labels), cumulative)
+
+class Collector:
+    # values that are already tracked elsewhere, read only when rendered;
+    # function returns a list of (labels, value)
+    def __init__(self, name, help, labels, function, type='gauge'):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self.type = type
+
+    def samples(self):
+        for (labels, value) in self.function():
+            yield (self.name, _labels(self.labels, labels), value)
+
+class Metrics:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._metrics = []
+
+    def add(self, metric):
+        metric.name = self.prefix + metric.name
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def collect(self, name, help, labels, function, type='gauge'):
+        return self.add(Collector(name, help, labels, function, type))
+
+    def render(self):
+        out = []
+        for metric in self._metrics:
+            out.append('# HELP %s %s' % (metric.name, metric.help))
+            out.append('# TYPE %s %s' % (metric.name, metric.type))
+            for (name, labels, value) in metric.samples():
+                out.append('%s%s %s' % (name, labels, _number(value)))
+        out.append('')
+        return '\n'.join(out)
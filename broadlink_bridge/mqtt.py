@@ -1,39 +1,183 @@
+import json
 import paho.mqtt.client as mqtt_client
 import ssl
 import urllib.parse
-from . import LOGGER, REGISTRY, Device
+from . import LOGGER, METRICS, REGISTRY, REQUESTS, Device, DeviceNotFoundError, Group, TransmitError, check_priority
+from .cluster import CLUSTER
+from .util import WorkerPool, parse_learn
 
 def mqtt_on_connect(client, userdata, flags, rc):
+    if rc != 0:
+        LOGGER.warning('MQTT client could not connect to broker %s: %s', client._host, mqtt_client.connack_string(rc))
+        return
     LOGGER.info('MQTT client connected to broker: %s', client._host)
+    # only the topics that are handled are subscribed, (re)done on every
+    # connection since the broker may not have kept the session
+    topics = [(userdata['prefix'] + topic, userdata['qos']) for topic in userdata['topics']]
+    client.subscribe(topics)
+    if CLUSTER.enabled:
+        CLUSTER.mqtt_on_connect(client)
 
 def mqtt_on_disconnect(client, userdata, rc):
     LOGGER.info('MQTT client disconnected from broker: %s', client._host)
 
+def mqtt_dispatch(handler):
+    # the network loop only hands messages over to the worker pool, so that
+    # a burst of messages cannot starve the keepalive
+    def dispatch(client, userdata, msg):
+        # the priority wildcard also matches the results the bridge publishes
+        if msg.topic.endswith('/result'):
+            return
+        REQUESTS.inc('mqtt')
+        # messages for the same device are handled by the same worker, which
+        # keeps them in the order they were published
+        topic = msg.topic[len(userdata['prefix']):].split('/')
+        key = topic[1] if topic[0] == 'device' and len(topic) > 1 else topic[0]
+        if not userdata['pool'].submit(handler, client, userdata, msg, key=key):
+            LOGGER.warning('MQTT %s: dropped, too many pending messages', msg.topic)
+    return dispatch
+
+def mqtt_owned(msg, device):
+    # every node receives every message, only the owner of the device acts
+    if CLUSTER.owns(device):
+        return True
+    LOGGER.debug('MQTT %s: owned by cluster node %s', msg.topic, CLUSTER.owner(device))
+    return False
+
 def mqtt_transmit(client, userdata, msg):
     LOGGER.debug('MQTT %s: received message', msg.topic)
     topic = msg.topic[len(userdata['prefix']):]
     topic = topic[len('device/'):]
-    topic = topic.split('/', 1)
+    topic = topic.split('/')
     device_id = topic[0]
     if not device_id:
         LOGGER.warning('MQTT %s: Device mising', msg.topic)
         return
+    priority = mqtt_priority(userdata, msg.topic, topic[2:])
+    if not priority:
+        return
     device = REGISTRY.find_device(device_id)
     if not device:
         LOGGER.warning('MQTT %s: Device not found: %s', msg.topic, device_id)
         return
+    if not mqtt_owned(msg, device):
+        return
     code = msg.payload
     if not code:
         LOGGER.warning('MQTT %s: No payload', msg.topic)
         return
+    # the code is only queued here, the device worker sends it so that the
+    # network loop is never blocked by a slow device
+    topic = msg.topic
+    def done(job):
+        if job.error:
+            LOGGER.warning('MQTT %s: transmit failed: %s', topic, str(job.error))
+        mqtt_publish_result(client, userdata, topic, job)
     try:
-        if device.transmit(code):
-            return
+        device.transmit(code, wait=False, callback=done, priority=priority)
+        return
+    except ValueError:
+        pass
     except Exception as error:
         LOGGER.warning('MQTT %s: transmit failed: %s', msg.topic, str(error))
+        # nothing was queued, so no job will report back
+        mqtt_publish_result(client, userdata, topic, {'device': str(device), 'status': 'rejected', 'error': str(error)})
+        return
     LOGGER.warning('MQTT %s: invalid payload', msg.topic)
 
-def mqtt_connect(url, prefix='broadlink'):
+def mqtt_priority(userdata, topic, suffix):
+    # optional priority suffix, e.g. prefix/device/DEVICE/transmit/bulk
+    if not suffix:
+        return userdata['priority']
+    try:
+        return check_priority(suffix[0])
+    except ValueError as error:
+        LOGGER.warning('MQTT %s: %s', topic, str(error))
+        return None
+
+def mqtt_repeat(client, userdata, msg):
+    LOGGER.debug('MQTT %s: received message', msg.topic)
+    (device_id, action) = msg.topic[len(userdata['prefix']) + len('device/'):].split('/', 1)
+    device = REGISTRY.find_device(device_id)
+    if not device:
+        LOGGER.warning('MQTT %s: Device not found: %s', msg.topic, device_id)
+        return
+    if not mqtt_owned(msg, device):
+        return
+    try:
+        if action == 'start':
+            if not msg.payload:
+                LOGGER.warning('MQTT %s: No payload', msg.topic)
+                return
+            device.start_repeat(msg.payload)
+        elif not device.stop_repeat(REGISTRY.decode(msg.payload)[0] if msg.payload else None):
+            LOGGER.debug('MQTT %s: not transmitting', msg.topic)
+    except ValueError:
+        LOGGER.warning('MQTT %s: invalid payload', msg.topic)
+    except TransmitError as error:
+        LOGGER.warning('MQTT %s: transmit failed: %s', msg.topic, str(error))
+
+def mqtt_learn(client, userdata, msg):
+    LOGGER.debug('MQTT %s: received message', msg.topic)
+    device_id = msg.topic[len(userdata['prefix']) + len('device/'):].split('/', 1)[0]
+    device = REGISTRY.find_device(device_id)
+    if not device:
+        LOGGER.warning('MQTT %s: Device not found: %s', msg.topic, device_id)
+        return
+    if isinstance(device, Group):
+        LOGGER.warning('MQTT %s: Groups cannot learn: %s', msg.topic, device_id)
+        return
+    if not mqtt_owned(msg, device):
+        return
+    # the learned code is the whole point, so it is published even when
+    # results are not
+    topic = msg.topic + '/result'
+    def done(session):
+        client.publish(topic, json.dumps(session.to_dict()), qos=userdata['qos'])
+    try:
+        (type, name) = parse_learn(msg.payload)
+        device.learn(type, name, callback=done)
+    except (ValueError, TransmitError) as error:
+        LOGGER.warning('MQTT %s: cannot learn: %s', msg.topic, str(error))
+        client.publish(topic, json.dumps({'device': str(device), 'status': 'rejected', 'error': str(error)}),
+                       qos=userdata['qos'])
+
+def mqtt_publish_result(client, userdata, topic, job):
+    if userdata['results']:
+        result = job if isinstance(job, dict) else job.to_dict()
+        client.publish(topic + '/result', json.dumps(result), qos=userdata['qos'])
+
+def mqtt_sequence(client, userdata, msg):
+    LOGGER.debug('MQTT %s: received message', msg.topic)
+    if not msg.payload:
+        LOGGER.warning('MQTT %s: No payload', msg.topic)
+        return
+    # sequences span devices, a single node runs them all
+    if not mqtt_owned(msg, 'sequence'):
+        return
+    topic = msg.topic
+    priority = mqtt_priority(userdata, topic, topic[len(userdata['prefix']):].split('/')[2:])
+    if not priority:
+        return
+    try:
+        REGISTRY.run_sequence(REGISTRY.parse_sequence(msg.payload), priority=priority,
+                              callback=lambda run: mqtt_publish_result(client, userdata, topic, run))
+    except (DeviceNotFoundError, ValueError) as error:
+        LOGGER.warning('MQTT %s: invalid sequence: %s', msg.topic, str(error))
+
+HANDLERS = {
+    'device/+/transmit': mqtt_transmit,
+    'device/+/transmit/+': mqtt_transmit,
+    'device/+/start': mqtt_repeat,
+    'device/+/stop': mqtt_repeat,
+    'device/+/learn': mqtt_learn,
+    'sequence/transmit': mqtt_sequence,
+    'sequence/transmit/+': mqtt_sequence,
+}
+
+def mqtt_connect(url, prefix='broadlink', results=False, qos=0, client_id='', clean_session=True,
+                 reconnect_min=1, reconnect_max=120, workers=4, queue_size=100, overflow='drop',
+                 priority='normal', keepalive=60):
     if not url:
         LOGGER.info('MQTT client disabled')
         return False
@@ -52,7 +196,10 @@ def mqtt_connect(url, prefix='broadlink'):
         else:
             raise ValueError('Invalid protocol: %s', url.scheme)
 
-    mqtt = mqtt_client.Client()
+    if not clean_session and not client_id:
+        LOGGER.warning('MQTT persistent session requires a client id, using a clean session')
+        clean_session = True
+    mqtt = mqtt_client.Client(client_id=client_id, clean_session=clean_session)
     if url.username or url.password:
         mqtt.username_pw_set(url.username, url.password)
     if url.scheme == 'mqtts':
@@ -62,14 +209,28 @@ def mqtt_connect(url, prefix='broadlink'):
             ctx.verify_mode = ssl.CERT_NONE
         mqtt.tls_set_context(ctx)
 
+    pool = WorkerPool('mqtt', workers, queue_size, overflow)
+    METRICS.collect('mqtt_pending', 'Received MQTT messages waiting for a worker', (), lambda: [((), len(pool))])
+    METRICS.collect('mqtt_dropped_total', 'Received MQTT messages dropped by a full queue', (),
+                    lambda: [((), pool.dropped)], type='counter')
     mqtt.user_data_set({
         'prefix': prefix,
+        'results': results,
+        'qos': qos,
+        'topics': list(HANDLERS.keys()),
+        'pool': pool,
+        'priority': check_priority(priority),
     })
     mqtt.enable_logger = True
     mqtt.on_connect = mqtt_on_connect
     mqtt.on_disconnect = mqtt_on_disconnect
-    mqtt.connect(url.hostname, port)
-    mqtt.message_callback_add(prefix + 'device/+/transmit', mqtt_transmit)
-    mqtt.subscribe(prefix + '#')
+    for (topic, handler) in HANDLERS.items():
+        mqtt.message_callback_add(prefix + topic, mqtt_dispatch(handler))
+    if CLUSTER.enabled:
+        CLUSTER.mqtt_setup(mqtt, prefix)
+    mqtt.reconnect_delay_set(reconnect_min, reconnect_max)
+    # connecting happens in the network loop, which keeps retrying with a
+    # backoff when the broker is unavailable
+    mqtt.connect_async(url.hostname, port, keepalive)
     mqtt.loop_start()
     return True
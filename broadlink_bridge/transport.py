@@ -0,0 +1,117 @@
+import broadlink
+import select
+import socket
+import threading
+import time
+
+HEADER = bytes.fromhex('5aa5aa555aa5aa55')
+
+class Transport:
+    # one bound UDP socket per device, reused for every packet instead of the
+    # socket python-broadlink opens (and closes) on each send_packet call
+    def __init__(self, timeout=1, attempts=3):
+        self.timeout = timeout
+        self.attempts = attempts
+        self.packets = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.rtt_last = 0.0
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def attach(self, dev):
+        # replaces send_packet on the handle only, so that everything built on
+        # it (auth, send_data, get_fwversion, ...) goes through this socket
+        dev.send_packet = lambda packet_type, payload: self.send_packet(dev, packet_type, payload)
+        return dev
+
+    def configure(self, timeout, attempts):
+        with self._lock:
+            self.timeout = timeout
+            self.attempts = attempts
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def _socket(self):
+        if not self._sock:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._sock.bind(('', 0))
+            self._sock.setblocking(False)
+        return self._sock
+
+    def send_packet(self, dev, packet_type, payload):
+        with self._lock:
+            dev.count = ((dev.count + 1) | 0x8000) & 0xffff
+            count = dev.count.to_bytes(2, 'little')
+            packet = bytearray(0x38)
+            packet[0x00:0x08] = HEADER
+            packet[0x24:0x26] = dev.devtype.to_bytes(2, 'little')
+            packet[0x26:0x28] = packet_type.to_bytes(2, 'little')
+            packet[0x28:0x2a] = count
+            packet[0x2a:0x30] = dev.mac[::-1]
+            packet[0x30:0x34] = dev.id.to_bytes(4, 'little')
+            packet[0x34:0x36] = (sum(payload, 0xbeaf) & 0xffff).to_bytes(2, 'little')
+            payload = bytes(payload) + bytes(-len(payload) % 16)
+            # the Cipher is kept on the handle, only the (single use) CBC
+            # context is created per packet
+            encryptor = dev.aes.encryptor()
+            packet += encryptor.update(payload) + encryptor.finalize()
+            packet[0x20:0x22] = (sum(packet, 0xbeaf) & 0xffff).to_bytes(2, 'little')
+
+            self.packets += 1
+            for attempt in range(self.attempts):
+                if attempt:
+                    self.retries += 1
+                try:
+                    response = self._exchange(dev.host, packet, count)
+                except OSError:
+                    # the socket is rebuilt on the next packet
+                    self._close()
+                    raise
+                if response is not None:
+                    break
+            else:
+                self.timeouts += 1
+                raise broadlink.exceptions.NetworkTimeoutError(
+                    -4000, 'Network timeout',
+                    'No response received within %ss (%s attempts)' % (self.timeout, self.attempts))
+
+        if len(response) < 0x30:
+            raise broadlink.exceptions.DataValidationError(
+                -4007, 'Received data packet length error',
+                'Expected at least 48 bytes and received %s' % len(response))
+        checksum = int.from_bytes(response[0x20:0x22], 'little')
+        if checksum != (sum(response, 0xbeaf) - sum(response[0x20:0x22])) & 0xffff:
+            raise broadlink.exceptions.DataValidationError(
+                -4008, 'Received data packet check error', 'Checksum mismatch')
+        return response
+
+    def _exchange(self, host, packet, count):
+        sock = self._socket()
+        sent = time.monotonic()
+        sock.sendto(packet, host)
+        deadline = sent + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if not select.select([sock], [], [], remaining)[0]:
+                return None
+            try:
+                (response, address) = sock.recvfrom(2048)
+            except BlockingIOError:
+                continue
+            # late acks of earlier (retried or timed out) packets are skipped,
+            # an ack is matched to its packet by the count
+            if address[0] != host[0] or response[0x28:0x2a] != count:
+                continue
+            self.rtt_last = time.monotonic() - sent
+            return response
@@ -1,10 +1,253 @@
 import base64
 import binascii
+import collections
 import copy
+import heapq
+import itertools
+import json
+import logging
 import re
 import socket
-import struct
+import socketserver
+import threading
+import time
 import urllib.parse
+from . import codec
+
+class BoundedThreadingMixIn(socketserver.ThreadingMixIn):
+    daemon_threads = True
+    block_on_close = False
+    max_threads = 16
+    label = 'Server'
+    # when saturated, either refuse the new connection right away (True) or
+    # close the connection that has been idle the longest to make room
+    reject_when_full = False
+
+    def process_request(self, request, client_address):
+        if not hasattr(self, 'slots'):
+            self.slots = threading.BoundedSemaphore(self.max_threads)
+            self.idle = collections.OrderedDict()
+            self.idle_lock = threading.Lock()
+        if not self.slots.acquire(blocking=False):
+            if self.reject_when_full:
+                logging.getLogger(__package__).warning('%s: %s clients connected, refusing %s',
+                                                       self.label, self.max_threads, client_address[0])
+                self.shutdown_request(request)
+                return
+            # a connection that is only waiting for its next request gives
+            # way; only when all are busy does accept block, so that further
+            # clients wait in the listen backlog instead of piling up threads
+            self.close_idle()
+            self.slots.acquire()
+        try:
+            super().process_request(request, client_address)
+        except:
+            self.slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.idle_lock:
+                self.idle.pop(request, None)
+            self.slots.release()
+
+    def set_idle(self, request, idle):
+        # returns False once an idle connection has been closed to make room
+        with self.idle_lock:
+            if idle:
+                self.idle[request] = True
+                return True
+            return self.idle.pop(request, None) is not None
+
+    def close_idle(self):
+        with self.idle_lock:
+            if not self.idle:
+                return False
+            request = self.idle.popitem(last=False)[0]
+        try:
+            request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        return True
+
+class Task:
+    def __init__(self, when, interval, function, args):
+        self.when = when
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler:
+    def __init__(self, workers=8):
+        self.workers = workers
+        self._queue = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._idle = 0
+
+    def call_soon(self, function, *args):
+        return self.call_at(time.monotonic(), function, *args)
+
+    def call_later(self, delay, function, *args):
+        return self.call_at(time.monotonic() + delay, function, *args)
+
+    def call_at(self, when, function, *args):
+        return self._schedule(Task(when, None, function, args))
+
+    def call_every(self, interval, function, *args, delay=None):
+        when = time.monotonic() + (interval if delay is None else delay)
+        return self._schedule(Task(when, interval, function, args))
+
+    def _schedule(self, task):
+        with self._cond:
+            heapq.heappush(self._queue, (task.when, next(self._counter), task))
+            # tasks block on device I/O, so start another worker (up to the
+            # limit) when there are more tasks than idle workers
+            if len(self._queue) > self._idle and len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='scheduler-%d' % len(self._threads))
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify()
+        return task
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._idle += 1
+                while True:
+                    now = time.monotonic()
+                    if self._queue and self._queue[0][0] <= now:
+                        task = heapq.heappop(self._queue)[2]
+                        if not task.cancelled:
+                            break
+                    else:
+                        self._cond.wait(self._queue[0][0] - now if self._queue else None)
+                self._idle -= 1
+            try:
+                task.function(*task.args)
+            except Exception:
+                logging.getLogger(__package__).exception('Background task %s failed', task.function)
+            if task.interval and not task.cancelled:
+                task.when = time.monotonic() + task.interval
+                self._schedule(task)
+
+class WorkerPool:
+    def __init__(self, name, workers=4, size=100, overflow='drop'):
+        if overflow not in ('drop', 'oldest'):
+            raise ValueError('Invalid overflow policy: ' + overflow)
+        self.name = name
+        self.workers = max(1, workers)
+        self.size = size
+        self.overflow = overflow
+        self.dropped = 0
+        # one queue per worker: items with the same key always go to the same
+        # worker, so they run one at a time in the order they were submitted
+        self._queues = [collections.deque() for _ in range(self.workers)]
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._threads = [None] * self.workers
+
+    def __len__(self):
+        return self._pending
+
+    def submit(self, function, *args, key=None):
+        # a saturated pool sheds work instead of growing without bound:
+        # either the new item ('drop') or the oldest queued one ('oldest')
+        with self._cond:
+            if key is None:
+                index = min(range(self.workers), key=lambda i: len(self._queues[i]))
+            else:
+                index = hash(key) % self.workers
+            queue = self._queues[index]
+            if self._pending >= self.size:
+                self.dropped += 1
+                if self.overflow == 'drop':
+                    return False
+                logging.getLogger(__package__).warning('%s: queue full, discarding oldest item', self.name)
+                (queue if queue else max(self._queues, key=len)).popleft()
+                self._pending -= 1
+            queue.append((function, args))
+            self._pending += 1
+            if self._threads[index] is None:
+                thread = threading.Thread(target=self._work, args=(queue,), name='%s-%d' % (self.name, index))
+                thread.daemon = True
+                self._threads[index] = thread
+                thread.start()
+            self._cond.notify_all()
+        return True
+
+    def _work(self, queue):
+        while True:
+            with self._cond:
+                while not queue:
+                    self._cond.wait()
+                (function, args) = queue.popleft()
+                self._pending -= 1
+            try:
+                function(*args)
+            except Exception:
+                logging.getLogger(__package__).exception('%s: task %s failed', self.name, function)
+
+class LRUCache:
+    def __init__(self, size=512):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def resize(self, size):
+        with self._lock:
+            self.size = size
+            while len(self._data) > max(size, 0):
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    @property
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'max_size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
 
 def get_ip_addresses(address):
     addrs = set()
@@ -48,34 +291,171 @@ def mac_parse(mac, reverse=False):
         mac = bytearray(mac)
     return mac
 
+DECODE_CACHE = LRUCache()
+
+class Normalizer:
+    # optional pass over every decoded code (see codec.normalize), keeping
+    # the original when it does not get shorter or, with validate, when the
+    # result would not send the same signal
+    def __init__(self):
+        self.enabled = False
+        self.tolerance = 0.15
+        self.validate = True
+        self.normalized = 0
+        self.rejected = 0
+        self.saved = 0
+        self._lock = threading.Lock()
+
+    def configure(self, enabled, tolerance=0.15, validate=True):
+        changed = (enabled, tolerance, validate) != (self.enabled, self.tolerance, self.validate)
+        (self.enabled, self.tolerance, self.validate) = (enabled, tolerance, validate)
+        if changed:
+            # cached codes were decoded with the previous settings
+            DECODE_CACHE.clear()
+
+    def normalize(self, code):
+        # returns (normalized, equivalent) regardless of the settings
+        normalized = codec.normalize(code, self.tolerance)
+        return (normalized, codec.equivalent(code, normalized))
+
+    def __call__(self, code):
+        if not self.enabled:
+            return code
+        try:
+            normalized = codec.normalize(code, self.tolerance)
+        except ValueError:
+            return code
+        if len(normalized) >= len(code):
+            return code
+        if self.validate and not codec.equivalent(code, normalized):
+            logging.getLogger(__package__).warning('Normalized code is not equivalent, keeping the original')
+            with self._lock:
+                self.rejected += 1
+            return code
+        with self._lock:
+            self.normalized += 1
+            self.saved += len(code) - len(normalized)
+        return normalized
+
+NORMALIZER = Normalizer()
+
 def ir_decode(code, repeat=None):
+    if not isinstance(code, str):
+        return ir_decode_uncached(code, repeat)
+
+    # raw payloads are cached by their normalized text, invalid codes are
+    # not cached and keep raising ValueError on every call
+    key = (code.replace(' ', ''), repeat)
+    result = DECODE_CACHE.get(key)
+    if result is None:
+        (code, repeat) = ir_decode_uncached(key[0], repeat)
+        result = (bytes(code), repeat)
+        DECODE_CACHE.put(key, result)
+    return result
+
+def ir_decode_uncached(code, repeat=None):
     if not code:
         raise ValueError('Empty code')
 
-    if code[0] not in [0x26, 0xb2, 0xd7]:
-        code = code.replace(' ', '')
+    owned = False
+    if code[0] not in codec.TYPES:
         (code, repeat) = ir_decode_multiply(code, repeat)
         if len(code) < 5:
             raise ValueError('Code too short')
         if code.startswith('0000'): # Pronto hex
             code = ir_decode_pronto(code)
+            owned = True
         else: # Broadlink base64
             code = base64.b64decode(code)
-        if code[0] not in [0x26, 0xb2, 0xd7]:
+        if code[0] not in codec.TYPES:
             raise ValueError('Not a valid Broadlink code')
+        # binary codes are already decoded (e.g. named commands), only codes
+        # that come in as text are normalized
+        if len(code) >= 6:
+            normalized = NORMALIZER(code)
+            if normalized is not code:
+                (code, owned) = (normalized, True)
 
     if len(code) < 6:
         raise ValueError('Code too short')
-    
+
     if repeat is not None:
-        code = bytearray(code)
+        # only copy when the packet may be shared with the caller
+        if not owned:
+            code = bytearray(code)
         code[1] = min((code[1] + 1) * (repeat + 1) - 1, 255)
     return (code, code[1])
 
+Step = collections.namedtuple('Step', ['device', 'code', 'repeat', 'delay'])
+
+def parse_sequence(text):
+    # one step per line (or separated by ';'): "DEVICE CODE [REPEAT]", or
+    # "wait MILLISECONDS" to delay the next step
+    steps = []
+    delay = 0
+    for line in re.split('[;\n]', text):
+        parts = line.split()
+        if not parts:
+            continue
+        if parts[0] == 'wait':
+            if len(parts) != 2 or not parts[1].isdigit():
+                raise ValueError('Invalid wait step: ' + line.strip())
+            delay += int(parts[1])
+            continue
+        if len(parts) not in (2, 3) or (len(parts) == 3 and not parts[2].isdigit()):
+            raise ValueError('Invalid step: ' + line.strip())
+        repeat = int(parts[2]) if len(parts) == 3 else None
+        steps.append(Step(parts[0], parts[1], repeat, delay))
+        delay = 0
+    if not steps:
+        raise ValueError('Sequence has no steps')
+    return steps
+
+def parse_sequence_json(data):
+    # [{"device": "tv", "code": "...", "repeat": 1, "delay": 200}, ...]
+    try:
+        data = json.loads(data)
+    except ValueError as e:
+        raise ValueError('Invalid JSON: %s' % e)
+    if not isinstance(data, list) or not data:
+        raise ValueError('Sequence should be a non-empty list of steps')
+    steps = []
+    for item in data:
+        try:
+            repeat = item.get('repeat')
+            steps.append(Step(str(item['device']), str(item['code']),
+                              int(repeat) if repeat is not None else None,
+                              int(item.get('delay', 0))))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            raise ValueError('Invalid step: %s' % (item,))
+    return steps
+
+def parse_learn(payload):
+    # empty, or a JSON object with the optional "type" ("ir" or "rf") and
+    # "name" (the command to save the code as)
+    if isinstance(payload, bytes):
+        payload = payload.decode('UTF-8')
+    if not payload.strip():
+        return ('ir', None)
+    try:
+        data = json.loads(payload)
+    except ValueError as e:
+        raise ValueError('Invalid JSON: %s' % e)
+    if not isinstance(data, dict):
+        raise ValueError('Learn request should be an object')
+    type = data.get('type', 'ir')
+    if type not in ('ir', 'rf'):
+        raise ValueError('Unknown code type: %s' % (type,))
+    name = data.get('name') or None
+    if name is not None and (not isinstance(name, str) or ' ' in name):
+        raise ValueError('Invalid command name: %s' % (name,))
+    return (type, name)
+
 MULTIPLY_PATTERN = re.compile('(?:([0-9]+)[*])(.*)')
 
 def ir_decode_multiply(code, repeat=None):
-    code = code.replace(' ', '')
+    if ' ' in code:
+        code = code.replace(' ', '')
     m = MULTIPLY_PATTERN.fullmatch(code)
     if m:
         number = int(m.group(1))
@@ -87,34 +467,4 @@ def ir_decode_multiply(code, repeat=None):
     return (code, repeat)
 
 def ir_decode_pronto(pronto) -> bytearray:
-    # Shameless stolen from:
-    # https://gist.githubusercontent.com/appden/42d5272bf128125b019c45bc2ed3311f/raw/bdede927b231933df0c1d6d47dcd140d466d9484/pronto2broadlink.py
-    codes = [int(pronto[i:i + 4], 16) for i in range(0, len(pronto), 4)]
-    if codes[0]:
-        raise ValueError('Pronto code should start with 0000')
-    if len(codes) < 4:
-        raise ValueError('Code is too short')
-    if len(codes) != 4 + 2 * (codes[2] + codes[3]):
-        raise ValueError('Number of pulse widths does not match preamble')
-    if codes[1] == 0:
-        raise ValueError('Invalid frequency')
-    frequency = 1 / (codes[1] * 0.241246)
-    pulses = [int(round(code / frequency)) for code in codes[4:]]
-    array = bytearray()
-    for pulse in pulses:
-        pulse = pulse * 269 // 8192  # 32.84ms units
-        if pulse < 256:
-            array += bytearray(struct.pack('>B', pulse))  # 1-byte (BE)
-        else:
-            array += bytearray([0x00])  # next number is 2-bytes
-            array += bytearray(struct.pack('>H', pulse))  # 2-bytes (BE)
-    packet = bytearray([0x26, 0x00])  # 0x26 = IR, 0x00 = repeats
-    packet += bytearray(struct.pack('<H', len(array)))  # byte count (LE)
-    packet += array
-    packet += bytearray([0x0d, 0x05])  # IR terminator
-    # Add 0s to make ultimate packet size a multiple of 16 for 128-bit
-    # AES encryption.
-    remainder = (len(packet) + 4) % 16  # add 4-byte header (02 00 00 00)
-    if remainder:
-        packet += bytearray(16 - remainder)
-    return packet
+    return codec.pronto_to_broadlink(pronto)
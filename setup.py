@@ -14,4 +14,7 @@ setup(
         'cryptography>=3.2',
         'paho-mqtt>=1.4.0',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
 )